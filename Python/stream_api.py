@@ -1,15 +1,196 @@
 """All the Stream API services organised in a single class."""
 
+import asyncio
+import itertools
+import threading
+from typing import Dict, List, Optional, Tuple
+
 import grpc
 
 from ma.streaming.api.v1 import api_pb2_grpc
 
+_COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "deflate": grpc.Compression.Deflate,
+    "gzip": grpc.Compression.Gzip,
+}
+
+
+class ChannelSettings:
+    """Settings applied to every channel created by the ChannelPool.
+
+    Keepalive pings are opt-in, as servers with a strict ping policy close the
+    connections that ping more often than they allow with a GOAWAY `too_many_pings`.
+
+    Attributes:
+        keepalive_time_ms: Interval between keepalive pings, in ms, or None to send
+            none.
+        keepalive_timeout_ms: Time to wait for a keepalive ping to be acknowledged
+            before the connection is considered dead, in ms.
+        keepalive_permit_without_calls: True to also send keepalive pings while the
+            channel has no call in progress.
+        max_receive_message_length: Largest message that can be received, in bytes.
+        max_send_message_length: Largest message that can be sent, in bytes, -1 for
+            no limit.
+        compression: One of "none", "deflate" or "gzip".
+        channels_per_address: Number of channels, each with its own HTTP/2
+            connection, that calls to an address are spread across. Every connection
+            multiplexes concurrent calls, so this only needs raising when a single
+            connection limits the number of concurrent streams.
+    """
+
+    def __init__(
+        self,
+        keepalive_time_ms: Optional[int] = None,
+        keepalive_timeout_ms: int = 10_000,
+        keepalive_permit_without_calls: bool = False,
+        max_receive_message_length: int = 8 * 1024 * 1024,
+        max_send_message_length: int = -1,
+        compression: str = "none",
+        channels_per_address: int = 1,
+    ):
+        self.keepalive_time_ms = keepalive_time_ms
+        self.keepalive_timeout_ms = keepalive_timeout_ms
+        self.keepalive_permit_without_calls = keepalive_permit_without_calls
+        self.max_receive_message_length = max_receive_message_length
+        self.max_send_message_length = max_send_message_length
+        self.compression = compression
+        self.channels_per_address = channels_per_address
+
+    @classmethod
+    def from_config(cls, config: dict) -> "ChannelSettings":
+        """Create the settings from the `grpcChannel` section of a Config.json."""
+        defaults = cls()
+        return cls(
+            keepalive_time_ms=config.get("keepaliveTimeMs", defaults.keepalive_time_ms),
+            keepalive_timeout_ms=config.get(
+                "keepaliveTimeoutMs", defaults.keepalive_timeout_ms
+            ),
+            keepalive_permit_without_calls=config.get(
+                "keepalivePermitWithoutCalls", defaults.keepalive_permit_without_calls
+            ),
+            max_receive_message_length=config.get(
+                "maxReceiveMessageLength", defaults.max_receive_message_length
+            ),
+            max_send_message_length=config.get(
+                "maxSendMessageLength", defaults.max_send_message_length
+            ),
+            compression=config.get("compression", defaults.compression),
+            channels_per_address=config.get(
+                "channelsPerAddress", defaults.channels_per_address
+            ),
+        )
+
+    @property
+    def options(self) -> List[Tuple[str, int]]:
+        """Channel arguments corresponding to the settings."""
+        options = [
+            ("grpc.max_receive_message_length", self.max_receive_message_length),
+            ("grpc.max_send_message_length", self.max_send_message_length),
+        ]
+        if self.keepalive_time_ms is not None:
+            options += [
+                ("grpc.keepalive_time_ms", self.keepalive_time_ms),
+                ("grpc.keepalive_timeout_ms", self.keepalive_timeout_ms),
+                (
+                    "grpc.keepalive_permit_without_calls",
+                    int(self.keepalive_permit_without_calls),
+                ),
+            ]
+        if self.channels_per_address > 1:
+            # Without a local subchannel pool, channels with the same arguments
+            # share a single connection.
+            options.append(("grpc.use_local_subchannel_pool", 1))
+        return options
+
+
+class ChannelPool:
+    """Process wide pool of gRPC channels shared by all the Stream API clients.
+
+    Blocking channels are shared across the process. grpc.aio channels are bound to
+    the event loop that created them, so they are shared within each event loop.
+    """
+
+    def __init__(self, settings: ChannelSettings = None):
+        self.settings = settings if settings is not None else ChannelSettings()
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._channels: Dict[str, List[grpc.Channel]] = {}
+        self._aio_channels: Dict[
+            Tuple[str, asyncio.AbstractEventLoop], List[grpc.aio.Channel]
+        ] = {}
+
+    def _pick(self, channels: list, create):
+        with self._lock:
+            if len(channels) < self.settings.channels_per_address:
+                channels.append(create())
+                return channels[-1]
+            return channels[next(self._counter) % len(channels)]
+
+    def channel(self, address: str) -> grpc.Channel:
+        """Get a blocking channel to `address`."""
+        channels = self._channels.setdefault(address, [])
+        return self._pick(
+            channels,
+            lambda: grpc.insecure_channel(
+                address,
+                options=self.settings.options,
+                compression=_COMPRESSION[self.settings.compression],
+            ),
+        )
+
+    def aio_channel(self, address: str) -> grpc.aio.Channel:
+        """Get a grpc.aio channel to `address` for the running event loop."""
+        key = (address, asyncio.get_running_loop())
+        channels = self._aio_channels.setdefault(key, [])
+        return self._pick(
+            channels,
+            lambda: grpc.aio.insecure_channel(
+                address,
+                options=self.settings.options,
+                compression=_COMPRESSION[self.settings.compression],
+            ),
+        )
+
+    def close(self):
+        """Close all the blocking channels."""
+        with self._lock:
+            channels = [c for cs in self._channels.values() for c in cs]
+            self._channels.clear()
+        for channel in channels:
+            channel.close()
+
+    async def close_aio(self):
+        """Close all the grpc.aio channels of the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            keys = [key for key in self._aio_channels if key[1] is loop]
+            channels = [c for key in keys for c in self._aio_channels.pop(key)]
+        for channel in channels:
+            await channel.close()
+
+
+channel_pool = ChannelPool()
+
+
+def configure_channel_pool(settings: ChannelSettings) -> None:
+    """Set the settings of the process wide channel pool.
+
+    Only channels created afterwards use the new settings, so this should be called
+    before any of the Stream API clients are created.
+    """
+    channel_pool.settings = settings
+
 
 class StreamApi:
-    """All the Stream API services organised in a single class."""
+    """All the Stream API services organised in a single class.
 
-    def __init__(self, address="localhost:13579"):
-        self.channel = grpc.insecure_channel(address)
+    Unless a channel is given, the channel is taken from the process wide
+    `channel_pool`, so all the instances share their connections.
+    """
+
+    def __init__(self, address="localhost:13579", channel=None):
+        self.channel = channel if channel is not None else channel_pool.channel(address)
 
         # Created the gRPC clients
         self.connection_manager_service_stub = (
@@ -27,3 +208,17 @@ class StreamApi:
         self.packet_writer_service_stub = api_pb2_grpc.PacketWriterServiceStub(
             self.channel
         )
+
+
+class AsyncStreamApi(StreamApi):
+    """All the Stream API services organised in a single class, using asyncio stubs.
+
+    Calls on the stubs return awaitables, so they don't block the event loop. The
+    class must be created, and used, within the event loop running the calls.
+    """
+
+    def __init__(self, address="localhost:13579", channel=None):
+        super().__init__(
+            address,
+            channel if channel is not None else channel_pool.aio_channel(address),
+        )
@@ -0,0 +1,83 @@
+"""Bounded cache of the results of a coroutine, with single flight loading."""
+
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class AsyncLruCache:
+    """Least recently used cache in front of a coroutine function.
+
+    Concurrent lookups of a key that is not cached share a single call of the loader,
+    so a burst of packets with the same unknown data format triggers one RPC. Failed
+    loads are not cached, and neither are None results, so loaders can return None
+    for not found.
+
+    The cache must be used from a single event loop.
+    """
+
+    def __init__(
+        self, loader: Callable[[Hashable], Awaitable[Any]], maxsize: int = 10_000
+    ):
+        self.loader = loader
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # Lookups that waited on a load started by another lookup.
+        self.coalesced = 0
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._loading: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    async def get(self, key: Hashable) -> Any:
+        """Get the value of `key`, loading it if it isn't cached."""
+        try:
+            value = self._entries[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+
+        task = self._loading.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(key))
+            self._loading[key] = task
+        else:
+            self.coalesced += 1
+        # A cancelled lookup mustn't cancel the load the other lookups are waiting on.
+        return await asyncio.shield(task)
+
+    async def _load(self, key: Hashable) -> Any:
+        try:
+            value = await self.loader(key)
+        finally:
+            del self._loading[key]
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Get the value of `key` if it is cached, without loading or reordering it."""
+        return self._entries.get(key, default)
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        return self._entries.pop(key, default)
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses + self.coalesced
+        return self.hits / lookups if lookups else 0.0
@@ -1,12 +1,21 @@
 import os
 import logging
-import random
-import struct
+import re
+import zlib
 import datetime
+import threading
 import time
-from typing import List
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
 
 from ma.streaming.open_data.v1 import open_data_pb2
+from stream_reader_sqlrace.config_cache import (
+    ConfigFingerprintCache,
+    config_fingerprint,
+    normalise_identifier,
+)
 from stream_reader_sqlrace.sql_race import SQLRaceDBConnection
 
 logger = logging.getLogger(__name__)
@@ -45,6 +54,10 @@ from System import (  # .NET imports, so pylint: disable=wrong-import-position,w
     Array,
     Int64,
     Double,
+    IntPtr,
+)
+from System.Runtime.InteropServices import (  # .NET imports, so pylint: disable=wrong-import-position,wrong-import-order,import-error
+    Marshal,
 )
 from MESL.SqlRace.Domain import (  # .NET imports, so pylint: disable=wrong-import-position,wrong-import-order,import-error
     Lap,
@@ -68,6 +81,128 @@ from MESL.SqlRace.Enumerators import (  # .NET imports, so pylint: disable=wrong
 )
 
 
+def _block_copy(source: np.ndarray, destination, length: int) -> None:
+    """Copy the first `length` elements of a contiguous array into a .NET array."""
+    Marshal.Copy(
+        IntPtr.__overloads__[Int64](source.ctypes.data), destination, 0, length
+    )
+
+
+class _ArraysByLength:
+    """.NET arrays kept by length, the least recently used lengths evicted first."""
+
+    def __init__(self, max_bytes: int, item_size: int):
+        self.max_bytes = max_bytes
+        self.item_size = item_size
+        self.nbytes = 0
+        self.arrays: "OrderedDict[int, List[Any]]" = OrderedDict()
+
+    def take(self, length: int) -> Optional[Any]:
+        """Remove and return an array of `length` items, None if there is none."""
+        arrays = self.arrays.get(length)
+        if arrays is None:
+            return None
+        array = arrays.pop()
+        if not arrays:
+            del self.arrays[length]
+        self.nbytes -= length * self.item_size
+        return array
+
+    def put(self, length: int, array) -> None:
+        nbytes = length * self.item_size
+        if nbytes > self.max_bytes:
+            return
+        self.arrays.setdefault(length, []).append(array)
+        self.arrays.move_to_end(length)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            oldest_length, oldest_arrays = next(iter(self.arrays.items()))
+            oldest_arrays.pop()
+            if not oldest_arrays:
+                del self.arrays[oldest_length]
+            self.nbytes -= oldest_length * self.item_size
+
+
+class NetArrayPool:
+    """Pool of .NET arrays used to hand samples over to SQLRace.
+
+    SQLRace takes the length of the arrays as the number of samples, so arrays are
+    pooled by their exact length. A channel is flushed with the same number of samples
+    from one flush to the next while its rate is steady, whether the flush is
+    triggered by `flush_sample_count` or by `flush_age`, so its arrays are reused once
+    its first flush has allocated them. At most `max_bytes` of arrays are kept in the
+    pool, the lengths used least recently being evicted first.
+
+    Reusing an array relies on `Session.AddRowData` not keeping a reference to it
+    once it returns, as the samples are written to the session by then. A pool with
+    `max_bytes` of 0 never reuses an array.
+    """
+
+    def __init__(self, max_bytes: int = 16 * 2**20):
+        # Half of the pool for each kind of array, as they are used in pairs.
+        self.byte_arrays = _ArraysByLength(max_bytes // 2, 1)
+        self.int64_arrays = _ArraysByLength(max_bytes // 2, 8)
+
+    def float64_to_bytes(self, values: np.ndarray):
+        """Copy float64 values into a .NET byte array, pooled if possible."""
+        values = np.ascontiguousarray(values, dtype=np.float64)
+        data_bytes = self.byte_arrays.take(values.nbytes)
+        if data_bytes is None:
+            data_bytes = Array[Byte](values.nbytes)
+        _block_copy(values, data_bytes, values.nbytes)
+        return data_bytes
+
+    def to_int64_array(self, values: np.ndarray):
+        """Copy int64 values into a .NET long array, pooled if possible."""
+        values = np.ascontiguousarray(values, dtype=np.int64)
+        int64_array = self.int64_arrays.take(len(values))
+        if int64_array is None:
+            int64_array = Array[Int64](len(values))
+        _block_copy(values, int64_array, len(values))
+        return int64_array
+
+    def release_bytes(self, data_bytes) -> None:
+        """Return a byte array obtained from `float64_to_bytes` to the pool."""
+        self.byte_arrays.put(data_bytes.Length, data_bytes)
+
+    def release_int64_array(self, int64_array) -> None:
+        """Return a long array obtained from `to_int64_array` to the pool."""
+        self.int64_arrays.put(int64_array.Length, int64_array)
+
+
+class ChannelWriteBuffer:
+    """Samples accumulated for a channel, waiting to be written in one call."""
+
+    def __init__(self):
+        self.values: List[np.ndarray] = []
+        self.timestamps: List[np.ndarray] = []
+        self.sample_count = 0
+        self.first_added = time.monotonic()
+
+    def add(self, values: np.ndarray, timestamps: np.ndarray) -> None:
+        if self.sample_count == 0:
+            self.first_added = time.monotonic()
+        self.values.append(values)
+        self.timestamps.append(timestamps)
+        self.sample_count += len(values)
+
+    def take(self):
+        """Remove and return all the buffered samples as (values, timestamps)."""
+        values = np.concatenate(self.values)
+        timestamps = np.concatenate(self.timestamps)
+        self.values.clear()
+        self.timestamps.clear()
+        self.sample_count = 0
+        return values, timestamps
+
+
+class ChannelPlan(NamedTuple):
+    """Channels of a list of parameters, resolved once for all their packets."""
+
+    parameter_identifiers: Tuple[str, ...]
+    channel_ids: np.ndarray
+
+
 class AtlasSessionWriter:
 
     def __init__(
@@ -75,12 +210,40 @@ class AtlasSessionWriter:
         data_source=r"MCLA-5JRZTQ3\LOCAL",
         database="SQLRACE01",
         session_identifier=f"Stream API DEMO {datetime.datetime.now()}",
+        config_cache_directory: Optional[str] = None,
     ):
         self.sql_race_connection = None
         self.session = None
         self.event_identifier_mapping = {}
         self.event_application_group_mapping = {}
         self.parameter_channel_id_mapping = {}
+        # Channel plans by parameter identifiers, cleared when config is added.
+        self.channel_plans: Dict[Tuple[str, ...], ChannelPlan] = {}
+        # Configs committed to the database, optionally saved across sessions, and the
+        # fingerprints of the configs already used by this session.
+        config_cache_path = None
+        if config_cache_directory is not None:
+            os.makedirs(config_cache_directory, exist_ok=True)
+            config_cache_path = os.path.join(
+                config_cache_directory,
+                re.sub(r"[^\w.-]", "_", f"{data_source}_{database}") + ".configs.json",
+            )
+        self.config_cache = ConfigFingerprintCache(config_cache_path)
+        self.used_configs = set()
+        # Highest row channel id reserved by the session, -1 if none is.
+        self.last_reserved_channel_id = -1
+        # Most channel ids reserved to move past the channels of a cached config.
+        self.max_channel_id_gap = 10_000
+        self.missing_config_commit_count = 0
+        self.missing_config_commit_time = 0.0  # seconds
+        # Samples are coalesced per channel, and written when either of these is
+        # reached. The buffer of a channel holds 16 bytes per sample, so at most
+        # 1.6 MB.
+        self.flush_sample_count = 100_000
+        self.array_pool = NetArrayPool()
+        self.flush_age = 5.0  # seconds
+        self.write_buffers: Dict[int, ChannelWriteBuffer] = {}
+        self.write_buffers_lock = threading.RLock()
         self.create_sqlrace_session(data_source, database, session_identifier)
 
     def create_sqlrace_session(
@@ -92,7 +255,9 @@ class AtlasSessionWriter:
         self.sql_race_connection = sql_db_connection
         self.session = sql_db_connection.session
 
-    def add_configration(self, packet: open_data_pb2.ConfigurationPacket):
+    def add_configration(
+        self, packet: open_data_pb2.ConfigurationPacket
+    ) -> Tuple[List[str], List[str]]:
         """Creates parameters in ATLAS Session from the configuration
 
         This is a simplified implementation of the SQLRace API and will throw away a
@@ -107,14 +272,44 @@ class AtlasSessionWriter:
             packet: Configuration Packet received from the Stream API.
 
         Returns:
-            None, config is created and committed to the session.
+            The identifiers of the parameters and of the events of the config which are
+            mapped to channels and event definitions of the session. Data of the others
+            can't be added yet.
         """
         logger.debug("Creating new config.")
-        config_identifier = packet.config_id
-        config_description = "Stream API generated config"
+        fingerprint = config_fingerprint(packet)
+        if fingerprint in self.used_configs:
+            logger.debug("Config %s already in use, skipped.", packet.config_id)
+            return self.mapped_identifiers(packet)
+        # Parameters may be mapped to new channels.
+        self.channel_plans.clear()
         configSetManager = (  # .NET objects, so pylint: disable=invalid-name
             ConfigurationSetManager.CreateConfigurationSetManager()
         )
+        config_identifier = packet.config_id
+        committed_config = self.config_cache.get(fingerprint)
+        if committed_config is not None:
+            if configSetManager.Exists(
+                DatabaseConnectionInformation(self.session.ConnectionString),
+                committed_config["config_identifier"],
+            ):
+                mapped_identifiers = self.use_committed_config(
+                    fingerprint, committed_config, packet
+                )
+                if mapped_identifiers is not None:
+                    return mapped_identifiers
+                # Its channels can't be reused, so the config is built again with new
+                # channels, under a new identifier as the database already has it.
+                config_identifier = f"{packet.config_id}_{time.time_ns()}"
+            else:
+                logger.warning(
+                    "Cached config %s is not in the database, rebuilding it.",
+                    committed_config["config_identifier"],
+                )
+                self.config_cache.remove(fingerprint)
+
+        build_start = time.perf_counter()
+        config_description = "Stream API generated config"
 
         # if we have processed this config previously then we can just use it
         if configSetManager.Exists(
@@ -127,7 +322,8 @@ class AtlasSessionWriter:
                 config_identifier,
             )
             self.session.UseLoggingConfigurationSet(config_identifier)
-            return
+            self.used_configs.add(fingerprint)
+            return self.mapped_identifiers(packet)
 
         config = configSetManager.Create(
             self.session.ConnectionString, config_identifier, config_description
@@ -149,7 +345,9 @@ class AtlasSessionWriter:
         for event_definition in packet.event_definitions:
             app_groups.add(event_definition.application_name)
 
-        # add applications and parameter group for all the app groups
+        # add applications and parameter group for all the app groups, and the list of
+        # parameter group identifiers shared by the parameters of each app
+        parameter_group_identifiers = {}
         for app in app_groups:
             group1 = ParameterGroup(app, app)
             config.AddParameterGroup(group1)
@@ -163,15 +361,27 @@ class AtlasSessionWriter:
             )
             applicationGroup.SupportsRda = False
             config.AddGroup(applicationGroup)
+            # .NET objects, so pylint: disable=invalid-name
+            parameterGroupIdentifiers = NETList[String]()
+            parameterGroupIdentifiers.Add(app)
+            parameter_group_identifiers[app] = parameterGroupIdentifiers
+
+        # Reserve the row channels of all the parameters in one pass. SQLRace only
+        # reserves channel ids one at a time.
+        channel_ids = [self.reserve_channel_id() for _ in packet.parameter_definitions]
+        parameter_channel_ids = {
+            parameter_definition.identifier: channel_id
+            for parameter_definition, channel_id in zip(
+                packet.parameter_definitions, channel_ids
+            )
+        }
+        self.parameter_channel_id_mapping.update(parameter_channel_ids)
 
         # Add a row channel per parameter
-        for parameter_definition in packet.parameter_definitions:
+        for parameter_definition, channel_id in zip(
+            packet.parameter_definitions, channel_ids
+        ):
             conversion = one_to_one_conversion_name
-            # Add a row channel
-            channel_id = self.session.ReserveNextAvailableRowChannelId() % 2147483647
-            self.parameter_channel_id_mapping[parameter_definition.identifier] = (
-                channel_id
-            )
             # .NET objects, so pylint: disable=invalid-name
             myParameterChannel = Channel(
                 channel_id,
@@ -202,10 +412,6 @@ class AtlasSessionWriter:
             myParamChannelId = NETList[UInt32]()
             myParamChannelId.Add(channel_id)
 
-            # .NET objects, so pylint: disable=invalid-name
-            parameterGroupIdentifiers = NETList[String]()
-            parameterGroupIdentifiers.Add(parameter_definition.application_name)
-
             # .NET objects, so pylint: disable=invalid-name
             myParameter = Parameter(
                 parameter_definition.identifier,
@@ -219,7 +425,7 @@ class AtlasSessionWriter:
                 0xFFFF,
                 0,
                 conversion,
-                parameterGroupIdentifiers,
+                parameter_group_identifiers[parameter_definition.application_name],
                 myParamChannelId,
                 parameter_definition.application_name,
                 parameter_definition.format_string,
@@ -280,6 +486,7 @@ class AtlasSessionWriter:
 
             config.AddEventDefinition(eventDefinition)
 
+        commit_start = time.perf_counter()
         try:
             config.Commit()
             logger.debug("Config committed, id: %s", config.Identifier)
@@ -288,9 +495,138 @@ class AtlasSessionWriter:
                 "Cannot commit config %s, config already exist.", config.Identifier
             )
         self.session.UseLoggingConfigurationSet(config.Identifier)
+        commit_end = time.perf_counter()
+        logger.info(
+            "Config %s with %i parameters and %i events: built in %.3f s, committed "
+            "in %.3f s.",
+            config_identifier,
+            len(packet.parameter_definitions),
+            len(packet.event_definitions),
+            commit_start - build_start,
+            commit_end - commit_start,
+        )
+
+        self.used_configs.add(fingerprint)
+        self.config_cache.add(
+            fingerprint,
+            config_identifier,
+            parameter_channel_ids,
+            {
+                event_definition.identifier: [
+                    event_definition.definition_id,
+                    event_definition.application_name,
+                ]
+                for event_definition in packet.event_definitions
+            },
+        )
+        return self.mapped_identifiers(packet)
+
+    def use_committed_config(
+        self,
+        fingerprint: str,
+        committed_config: dict,
+        packet: open_data_pb2.ConfigurationPacket,
+    ) -> Optional[Tuple[List[str], List[str]]]:
+        """Use a config found in the config cache and in the database.
+
+        The channel ids of the config were reserved by an earlier session. They are
+        only reused if none of them is mapped in this session and they are all past
+        the channel ids this session reserved, in which case the channel ids reserved
+        from now on are moved past them.
+
+        Returns:
+            The identifiers mapped in the session, as `add_configration` does, or None
+            if the channels of the config can't be reused.
+        """
+        config_identifier = committed_config["config_identifier"]
+        parameter_channel_ids = committed_config["parameters"]
+        if parameter_channel_ids:
+            channel_ids = set(parameter_channel_ids.values())
+            if (
+                not channel_ids.isdisjoint(self.parameter_channel_id_mapping.values())
+                or min(channel_ids) <= self.last_reserved_channel_id
+            ):
+                logger.warning(
+                    "Channels of cached config %s may already be used by the session, "
+                    "rebuilding it with new channels.",
+                    config_identifier,
+                )
+                return None
+            if not self.reserve_channel_ids_past(max(channel_ids)):
+                logger.warning(
+                    "Cannot reserve the channels of the session past those of cached "
+                    "config %s, rebuilding it with new channels.",
+                    config_identifier,
+                )
+                return None
+        logger.info(
+            "Config %s already committed, using it without rebuilding it.",
+            config_identifier,
+        )
+        self.parameter_channel_id_mapping.update(parameter_channel_ids)
+        for event_identifier, event in committed_config["events"].items():
+            self.event_identifier_mapping[event_identifier] = event[0]
+            self.event_application_group_mapping[event_identifier] = event[1]
+        self.session.UseLoggingConfigurationSet(config_identifier)
+        self.used_configs.add(fingerprint)
+        return self.mapped_identifiers(packet)
+
+    def reserve_channel_id(self) -> int:
+        """Reserve the next available row channel id of the session."""
+        channel_id = self.session.ReserveNextAvailableRowChannelId() % 2147483647
+        self.last_reserved_channel_id = max(self.last_reserved_channel_id, channel_id)
+        return channel_id
+
+    def reserve_channel_ids_past(self, channel_id: int) -> bool:
+        """Reserve row channel ids until the next one reserved is past `channel_id`.
+
+        SQLRace reserves channel ids one at a time, so no more ids are reserved if
+        `channel_id` is more than `max_channel_id_gap` past the next one.
+
+        Returns:
+            True if the channel ids reserved from now on are past `channel_id`.
+        """
+        if self.last_reserved_channel_id >= channel_id:
+            return True
+        self.reserve_channel_id()
+        if channel_id - self.last_reserved_channel_id > self.max_channel_id_gap:
+            return False
+        reserved_count = 1
+        while self.last_reserved_channel_id < channel_id:
+            previous_channel_id = self.last_reserved_channel_id
+            if self.reserve_channel_id() <= previous_channel_id:
+                # Channel ids wrapped around, they won't reach `channel_id`.
+                return False
+            reserved_count += 1
+        logger.debug(
+            "Reserved %i channel ids to move past channel %i.",
+            reserved_count,
+            channel_id,
+        )
+        return True
+
+    def mapped_identifiers(
+        self, packet: open_data_pb2.ConfigurationPacket
+    ) -> Tuple[List[str], List[str]]:
+        """Identifiers of the parameters and events of a config mapped in the session.
+
+        Only these can have their data added to the session.
+        """
+        return (
+            [
+                parameter_definition.identifier
+                for parameter_definition in packet.parameter_definitions
+                if parameter_definition.identifier in self.parameter_channel_id_mapping
+            ],
+            [
+                event_definition.identifier
+                for event_definition in packet.event_definitions
+                if event_definition.identifier in self.event_identifier_mapping
+            ],
+        )
 
     def add_data(
-        self, parameter_identifier: str, data: List[float], timestamps: List[float]
+        self, parameter_identifier: str, data: np.ndarray, timestamps: np.ndarray
     ) -> bool:
         """Add data to a parameter.
 
@@ -298,17 +634,18 @@ class AtlasSessionWriter:
         If the config for the parameter was not processed beforehand data will not be
         added.
 
+        Data are buffered for the channel and written to the session when the buffer
+        reaches `flush_sample_count` or `flush_age`.
+
         Args:
             parameter_identifier: Parameter identifier to add the data to
-            data: List of data
-            timestamps: List of timestamp in SQLRace format
+            data: Array of data, converted to float64 if needed
+            timestamps: Array of timestamp in SQLRace format
 
         Returns:
             True if the config is found and data added.
         """
-        # if there are no app group for parameter identifier
-        if len(parameter_identifier.split(":")) == 1:
-            parameter_identifier = parameter_identifier + ":StreamAPI"
+        parameter_identifier = normalise_identifier(parameter_identifier)
         if parameter_identifier in self.parameter_channel_id_mapping:
             channel_id = self.parameter_channel_id_mapping[parameter_identifier]
         else:
@@ -318,56 +655,122 @@ class AtlasSessionWriter:
             )
             return False
 
-        databytes = bytearray(len(data) * 8)
-        for i, value in enumerate(data):
-            new_bytes = struct.pack("d", value)
-            databytes[i * 8 : i * 8 + len(new_bytes)] = new_bytes
+        self.buffer_samples(channel_id, data, timestamps)
+        return True
 
-        timestamps_array = Array[Int64](len(timestamps))
-        for i, timestamp in enumerate(timestamps):
-            timestamps_array[i] = Int64(int(timestamp))
+    def get_channel_plan(
+        self, parameter_identifiers: List[str]
+    ) -> Optional[ChannelPlan]:
+        """Get the channels of a list of parameters, resolving them on first use.
 
-        self.session.AddRowData(channel_id, timestamps_array, databytes, 8, False)
+        Returns:
+            The channel plan, or None if any of the parameters is not configured.
+        """
+        key = tuple(parameter_identifiers)
+        channel_plan = self.channel_plans.get(key)
+        if channel_plan is not None:
+            return channel_plan
+
+        normalised_identifiers = tuple(map(normalise_identifier, key))
+        if any(
+            parameter_identifier not in self.parameter_channel_id_mapping
+            for parameter_identifier in normalised_identifiers
+        ):
+            return None
+        channel_ids = np.array(
+            [
+                self.parameter_channel_id_mapping[parameter_identifier]
+                for parameter_identifier in normalised_identifiers
+            ],
+            dtype=np.uint32,
+        )
+        channel_plan = ChannelPlan(normalised_identifiers, channel_ids)
+        self.channel_plans[key] = channel_plan
+        return channel_plan
 
-        return True
+    def buffer_samples(
+        self, channel_id: int, data: np.ndarray, timestamps: np.ndarray
+    ) -> None:
+        """Buffer samples of a channel, writing them once a flush threshold is met."""
+        with self.write_buffers_lock:
+            write_buffer = self.write_buffers.get(channel_id)
+            if write_buffer is None:
+                write_buffer = self.write_buffers[channel_id] = ChannelWriteBuffer()
+            write_buffer.add(
+                np.asarray(data, dtype=np.float64),
+                np.asarray(timestamps, dtype=np.int64),
+            )
+            if (
+                write_buffer.sample_count >= self.flush_sample_count
+                or time.monotonic() - write_buffer.first_added >= self.flush_age
+            ):
+                self.flush_channel(channel_id)
+
+    def flush_channel(self, channel_id: int) -> None:
+        """Write all the buffered samples of a channel to the session.
 
-    def add_row(
-        self, parameter_identifiers: str, row: List[float], timestamp: float
+        The samples are written `flush_sample_count` at a time, in pooled arrays.
+        """
+        with self.write_buffers_lock:
+            write_buffer = self.write_buffers.get(channel_id)
+            if write_buffer is None or write_buffer.sample_count == 0:
+                return
+            data, timestamps = write_buffer.take()
+            for start in range(0, len(data), self.flush_sample_count):
+                end = start + self.flush_sample_count
+                databytes = self.array_pool.float64_to_bytes(data[start:end])
+                timestamps_array = self.array_pool.to_int64_array(timestamps[start:end])
+                try:
+                    self.session.AddRowData(
+                        channel_id, timestamps_array, databytes, 8, False
+                    )
+                finally:
+                    self.array_pool.release_bytes(databytes)
+                    self.array_pool.release_int64_array(timestamps_array)
+
+    def flush_expired(self) -> None:
+        """Write the buffered samples of channels that are older than `flush_age`."""
+        now = time.monotonic()
+        with self.write_buffers_lock:
+            for channel_id, write_buffer in self.write_buffers.items():
+                if (
+                    write_buffer.sample_count > 0
+                    and now - write_buffer.first_added >= self.flush_age
+                ):
+                    self.flush_channel(channel_id)
+
+    def flush(self) -> None:
+        """Write the buffered samples of all channels."""
+        with self.write_buffers_lock:
+            for channel_id in self.write_buffers:
+                self.flush_channel(channel_id)
+
+    def add_columns(
+        self,
+        parameter_identifiers: List[str],
+        values: np.ndarray,
+        timestamps: np.ndarray,
     ) -> bool:
-        """Add a row of data to the session.
+        """Add the columns of a samples x parameters matrix to their parameters.
 
         Args:
-            parameter_identifiers: Names of parameter identifiers
-            row: The row of data to be added.
-            timestamp: Timestamp corresponds to the row of data
+            parameter_identifiers: Parameter identifier of each column.
+            values: Samples x parameters matrix of data.
+            timestamps: Array of timestamp in SQLRace format, one per sample.
 
         Returns:
-
+            True if the config is found and data added for all the parameters.
         """
-        channelIds = NETList[UInt32]()  # .NET objects, so pylint: disable=invalid-name
-        for parameter_identifier in parameter_identifiers:
-            # if there are no app group for parameter identifier
-            if len(parameter_identifier.split(":")) == 1:
-                parameter_identifier = parameter_identifier + ":StreamAPI"
-            if parameter_identifier in self.parameter_channel_id_mapping:
-                channel_id = self.parameter_channel_id_mapping[parameter_identifier]
-            else:
-                logger.warning(
-                    "No config processed for parameter %s, data not added",
-                    parameter_identifier,
-                )
-                return False
-            channelIds.Add(channel_id)
-
-        databytes = bytearray(len(row) * 8)
-        for i, value in enumerate(row):
-            new_bytes = struct.pack("d", value)
-            databytes[i * 8 : i * 8 + len(new_bytes)] = new_bytes
-
-        timestamp = Int64(int(timestamp))
-
-        self.session.AddRowData(timestamp, channelIds, databytes)
-
+        channel_plan = self.get_channel_plan(parameter_identifiers)
+        if channel_plan is None:
+            # Add what can be added, warning about the parameters without config.
+            added = True
+            for i, parameter_identifier in enumerate(parameter_identifiers):
+                added &= self.add_data(parameter_identifier, values[:, i], timestamps)
+            return added
+
+        for i, channel_id in enumerate(channel_plan.channel_ids.tolist()):
+            self.buffer_samples(channel_id, values[:, i], timestamps)
         return True
 
     def add_lap(
@@ -405,9 +808,14 @@ class AtlasSessionWriter:
     def close_session(self):
         # Close the session if one was created
         if self.sql_race_connection is not None:
+            self.flush()
             self.sql_race_connection.close_session()
             self.sql_race_connection = None
 
+    def update_identifier(self, identifier: str):
+        """Update the identifier of the session."""
+        self.session.UpdateIdentifier(identifier)
+
     def add_details(self, key, value):
         """Add a session detail to the session."""
         session_item = SessionDataItem(key, value)
@@ -451,9 +859,13 @@ class AtlasSessionWriter:
                 parameter_definitions.append(param_def)
 
         event_definitions = []
+        used_definition_ids = set(self.event_identifier_mapping.values())
 
         for event_identifier in event_identifiers:
-            event_definition_id = random.randint(0, 2**16)
+            event_definition_id = self.assign_event_definition_id(
+                event_identifier, used_definition_ids
+            )
+            used_definition_ids.add(event_definition_id)
 
             event_definition = open_data_pb2.EventDefinition(
                 identifier=event_identifier,
@@ -473,11 +885,32 @@ class AtlasSessionWriter:
         )
 
         if len(parameter_definitions) != 0 or len(event_definitions) != 0:
+            start = time.perf_counter()
+            self.add_configration(config_packet)
+            commit_time = time.perf_counter() - start
+            self.missing_config_commit_count += 1
+            self.missing_config_commit_time += commit_time
             logger.info(
-                "Adding missing config for %i parameters.", len(parameter_definitions)
+                "Added missing config for %i parameters and %i events in %.3f s. "
+                "%i missing config commits so far, %.3f s on average.",
+                len(parameter_definitions),
+                len(event_definitions),
+                commit_time,
+                self.missing_config_commit_count,
+                self.missing_config_commit_time / self.missing_config_commit_count,
             )
-            logger.info("Adding missing config for %i events.", len(event_definitions))
-            self.add_configration(config_packet)
+
+    @staticmethod
+    def assign_event_definition_id(event_identifier: str, used_definition_ids) -> int:
+        """Event definition id derived from the event identifier.
+
+        The id is a hash of the identifier, moved to the next free id on collision, so
+        the same events get the same ids from one session to the next.
+        """
+        definition_id = zlib.crc32(event_identifier.encode()) % 2**16
+        while definition_id in used_definition_ids:
+            definition_id = (definition_id + 1) % 2**16
+        return definition_id
 
     def build_parameter_definition_packet(self, name: str, app: str = "StreamAPI"):
         param_def = open_data_pb2.ParameterDefinition(
@@ -0,0 +1,117 @@
+"""In-process, thread safe FIFO queues keyed by data format identifier."""
+
+import threading
+from collections import defaultdict, deque
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional
+
+
+class KeyedBatchQueue:
+    """A set of FIFO queues, one per key, drained in batches.
+
+    Items never leave the process, so they are stored as references rather than
+    being pickled. Depths are tracked as the items are added and removed, so
+    querying the depth of a queue, the depth of the deepest queue or the total number
+    of items is O(1).
+
+    If a `sizeof` function is given, the total size of the items is kept in `nbytes`
+    the same way.
+    """
+
+    def __init__(self, sizeof: Optional[Callable[[Any], int]] = None):
+        self._lock = threading.Lock()
+        self._queues: Dict[Hashable, Deque[Any]] = {}
+        self._total = 0
+        # Number of queues of each non-zero depth, and the depth of the deepest one.
+        self._depth_counts: Dict[int, int] = defaultdict(int)
+        self._max_depth = 0
+        self.sizeof = sizeof
+        self.nbytes = 0
+
+    def __len__(self) -> int:
+        return self._total
+
+    def put(self, key: Hashable, item: Any) -> int:
+        """Add an item to the queue of `key`.
+
+        Returns:
+            Depth of the queue of `key` after adding the item.
+        """
+        nbytes = 0 if self.sizeof is None else self.sizeof(item)
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+            queue.append(item)
+            self._total += 1
+            self._move_depth(len(queue) - 1, len(queue))
+            self.nbytes += nbytes
+            return len(queue)
+
+    def put_many(self, key: Hashable, items: List[Any]) -> int:
+        """Add items to the queue of `key`, in order.
+
+        Returns:
+            Depth of the queue of `key` after adding the items.
+        """
+        nbytes = 0 if self.sizeof is None else sum(map(self.sizeof, items))
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+            queue.extend(items)
+            self._total += len(items)
+            self._move_depth(len(queue) - len(items), len(queue))
+            self.nbytes += nbytes
+            return len(queue)
+
+    def drain(self, key: Hashable, max_items: int) -> List[Any]:
+        """Remove and return up to `max_items` from the head of the queue of `key`."""
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is None:
+                return []
+            count = min(max_items, len(queue))
+            items = [queue.popleft() for _ in range(count)]
+            self._total -= count
+            self._move_depth(len(queue) + count, len(queue))
+        if self.sizeof is not None:
+            nbytes = sum(map(self.sizeof, items))
+            with self._lock:
+                self.nbytes -= nbytes
+        return items
+
+    def _move_depth(self, old_depth: int, new_depth: int) -> None:
+        """Account for a queue going from `old_depth` to `new_depth` items.
+
+        Lowering the deepest depth steps down one depth at a time, which is at most
+        the number of items drained, so it stays O(1) per item.
+        """
+        if old_depth == new_depth:
+            return
+        if old_depth > 0:
+            self._depth_counts[old_depth] -= 1
+            if self._depth_counts[old_depth] == 0:
+                del self._depth_counts[old_depth]
+        if new_depth > 0:
+            self._depth_counts[new_depth] += 1
+        if new_depth > self._max_depth:
+            self._max_depth = new_depth
+        while self._max_depth > 0 and self._max_depth not in self._depth_counts:
+            self._max_depth -= 1
+
+    def depth(self, key: Hashable) -> int:
+        """Number of items in the queue of `key`."""
+        queue = self._queues.get(key)
+        return 0 if queue is None else len(queue)
+
+    @property
+    def max_depth(self) -> int:
+        """Depth of the deepest queue."""
+        return self._max_depth
+
+    def keys_by_depth(self) -> List[Hashable]:
+        """Keys of all the queues, deepest first."""
+        with self._lock:
+            return sorted(
+                self._queues, key=lambda key: len(self._queues[key]), reverse=True
+            )
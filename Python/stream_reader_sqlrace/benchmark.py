@@ -0,0 +1,487 @@
+"""Micro-benchmarks for the hot paths of the stream reader.
+
+Run from the project root, so `ma` and `stream_reader_sqlrace` can be imported.
+
+    python -m stream_reader_sqlrace.benchmark
+"""
+
+import asyncio
+import gc
+import logging
+import os
+import struct
+import time
+import timeit
+import tracemalloc
+from collections import deque
+from concurrent import futures
+
+import grpc
+import numpy as np
+
+from ma.streaming.api.v1 import api_pb2, api_pb2_grpc
+from ma.streaming.open_data.v1 import open_data_pb2
+from stream_api import AsyncStreamApi, StreamApi, channel_pool
+from stream_reader_sqlrace.data_format_cache import DataFormatCache
+from stream_reader_sqlrace.decode_pool import DecodePool, decode_periodic_contents
+from stream_reader_sqlrace.packet_backlog import BufferedPacket, PacketBacklog
+from stream_reader_sqlrace.packet_decoder import decode_periodic_packet
+from stream_reader_sqlrace.packet_dispatch import PacketRegistry
+
+logger = logging.getLogger(__name__)
+
+
+def build_periodic_packet(
+    parameter_count: int = 200, sample_count: int = 1000
+) -> open_data_pb2.PeriodicDataPacket:
+    """Build a 1 s, 1 kHz PeriodicDataPacket with every tenth sample invalid."""
+    columns = []
+    for i in range(parameter_count):
+        samples = [
+            open_data_pb2.DoubleSample(
+                value=np.sin(i + j / sample_count),
+                status=(
+                    open_data_pb2.DataStatus.DATA_STATUS_INVALID
+                    if j % 10 == 0
+                    else open_data_pb2.DataStatus.DATA_STATUS_VALID
+                ),
+            )
+            for j in range(sample_count)
+        ]
+        columns.append(
+            open_data_pb2.SampleColumn(
+                double_samples=open_data_pb2.DoubleSampleList(samples=samples)
+            )
+        )
+    return open_data_pb2.PeriodicDataPacket(
+        data_format=open_data_pb2.SampleDataFormat(data_format_identifier=1),
+        start_time=1_700_000_000_000_000_000,
+        interval=1_000_000,
+        columns=columns,
+    )
+
+
+def _decode_periodic_packet_per_sample(packet: open_data_pb2.PeriodicDataPacket):
+    """Decoding as previously done in `StreamReaderSql.handle_periodic_packet`."""
+    data = []
+    status = []
+    for column in packet.columns:
+        samples = getattr(column, column.WhichOneof("list")).samples
+        data.append([s.value for s in samples])
+        status.append([s.status for s in samples])
+    timestamps_ns = [
+        packet.start_time + packet.interval * i for i in range(len(data[0]))
+    ]
+    timestamps_sqlrace = np.mod(timestamps_ns, np.int64(1e9 * 3600 * 24))
+    return data, status, timestamps_sqlrace
+
+
+def _report(name: str, baseline: float, candidate: float, unit: str):
+    logger.info(
+        "%s: before %.3f %s, after %.3f %s, speed up x%.1f",
+        name,
+        baseline,
+        unit,
+        candidate,
+        unit,
+        baseline / candidate,
+    )
+
+
+def bench_periodic_decode(parameter_count: int = 200, repeat: int = 5):
+    """Compare the per-sample decoding against the columnar decoding."""
+    packet = build_periodic_packet(parameter_count)
+    baseline = min(
+        timeit.repeat(
+            lambda: _decode_periodic_packet_per_sample(packet), number=1, repeat=repeat
+        )
+    )
+    candidate = min(
+        timeit.repeat(lambda: decode_periodic_packet(packet), number=1, repeat=repeat)
+    )
+    _report(
+        f"Periodic decode, {parameter_count} parameters x 1000 samples",
+        baseline * 1e3,
+        candidate * 1e3,
+        "ms",
+    )
+
+
+def bench_sample_encoding(sample_count: int = 1000, repeat: int = 5):
+    """Compare the per-sample .NET encoding against the pooled block copy.
+
+    This requires the SQLRace API, so it can only run on a host with ATLAS installed.
+    """
+    # Importing the writer loads the SQLRace assemblies.
+    # pylint: disable-next=import-outside-toplevel
+    from stream_reader_sqlrace.atlas_session_writer import Array, Int64, NetArrayPool
+
+    values = np.sin(np.arange(sample_count, dtype=np.float64))
+    timestamps = np.arange(sample_count, dtype=np.int64) * 1_000_000
+
+    def encode_per_sample():
+        databytes = bytearray(len(values) * 8)
+        for i, value in enumerate(values):
+            new_bytes = struct.pack("d", value)
+            databytes[i * 8 : i * 8 + len(new_bytes)] = new_bytes
+        timestamps_array = Array[Int64](len(timestamps))
+        for i, timestamp in enumerate(timestamps):
+            timestamps_array[i] = Int64(int(timestamp))
+
+    pool = NetArrayPool()
+
+    def encode_block_copy():
+        pool.release_bytes(pool.float64_to_bytes(values))
+        pool.release_int64_array(pool.to_int64_array(timestamps))
+
+    baseline = min(timeit.repeat(encode_per_sample, number=100, repeat=repeat)) / 100
+    candidate = min(timeit.repeat(encode_block_copy, number=100, repeat=repeat)) / 100
+    _report(
+        f"Sample encoding, {sample_count} samples",
+        baseline * 1e6,
+        candidate * 1e6,
+        "us",
+    )
+
+
+class _StandInDataFormatManager(api_pb2_grpc.DataFormatManagerServiceServicer):
+    """Stand-in for the Stream API server, answering after a fixed latency."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.call_count = 0
+
+    def GetEvent(
+        self, request, context
+    ):  # gRPC method name, so pylint: disable=invalid-name
+        self.call_count += 1
+        time.sleep(self.latency)
+        return api_pb2.GetEventResponse(event="Event:StandIn")
+
+    def GetParametersList(
+        self, request, context
+    ):  # gRPC method name, so pylint: disable=invalid-name
+        self.call_count += 1
+        time.sleep(self.latency)
+        return api_pb2.GetParametersListResponse(
+            parameters=[f"Parameter{i}:StandIn" for i in range(10)]
+        )
+
+
+async def _measure_event_lookups(lookup, call_count: int):
+    """Time `call_count` concurrent lookups, and the longest event loop stall."""
+    longest_stall = 0.0
+    done = False
+
+    async def heartbeat():
+        nonlocal longest_stall
+        while not done:
+            tick = time.perf_counter()
+            await asyncio.sleep(0.001)
+            longest_stall = max(longest_stall, time.perf_counter() - tick - 0.001)
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    await asyncio.gather(*[lookup() for _ in range(call_count)])
+    elapsed = time.perf_counter() - start
+    done = True
+    await heartbeat_task
+    return elapsed, longest_stall
+
+
+def _start_stand_in_server(latency: float):
+    servicer = _StandInDataFormatManager(latency)
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=32))
+    api_pb2_grpc.add_DataFormatManagerServiceServicer_to_server(servicer, server)
+    port = server.add_insecure_port("localhost:0")
+    server.start()
+    return server, servicer, f"localhost:{port}"
+
+
+def bench_unary_rpcs(call_count: int = 100, latency: float = 0.002):
+    """Compare blocking and asyncio GetEvent calls made from within the event loop."""
+    server, _, address = _start_stand_in_server(latency)
+    request = api_pb2.GetEventRequest(data_source="Default", data_format_identifier=1)
+
+    async def run():
+        blocking_stub = StreamApi(address).data_format_manager_service_stub
+        async_stub = AsyncStreamApi(address).data_format_manager_service_stub
+
+        async def blocking_lookup():
+            return blocking_stub.GetEvent(request)
+
+        async def async_lookup():
+            return await async_stub.GetEvent(request)
+
+        # Warm up the connections before measuring.
+        await blocking_lookup()
+        await async_lookup()
+        baseline = await _measure_event_lookups(blocking_lookup, call_count)
+        candidate = await _measure_event_lookups(async_lookup, call_count)
+        await channel_pool.close_aio()
+        return baseline, candidate
+
+    try:
+        baseline, candidate = asyncio.run(run())
+    finally:
+        server.stop(None)
+    _report(
+        f"{call_count} concurrent GetEvent, total time",
+        baseline[0] * 1e3,
+        candidate[0] * 1e3,
+        "ms",
+    )
+    _report(
+        f"{call_count} concurrent GetEvent, longest event loop stall",
+        baseline[1] * 1e3,
+        candidate[1] * 1e3,
+        "ms",
+    )
+
+
+def bench_concurrent_lookups(packet_count: int = 500, latency: float = 0.002):
+    """Count the RPCs made when packets of an unknown data format arrive together."""
+    server, servicer, address = _start_stand_in_server(latency)
+    request = api_pb2.GetParametersListRequest(
+        data_source="Default", data_format_identifier=1
+    )
+
+    async def run():
+        stub = AsyncStreamApi(address).data_format_manager_service_stub
+        # Without single flight, every packet missing the cache makes its own RPC.
+        await asyncio.gather(
+            *[stub.GetParametersList(request) for _ in range(packet_count)]
+        )
+        baseline = servicer.call_count
+        servicer.call_count = 0
+        cache = DataFormatCache("Default", address)
+        await asyncio.gather(
+            *[cache.get_cached_parameter_list(1) for _ in range(packet_count)]
+        )
+        await channel_pool.close_aio()
+        return baseline, servicer.call_count
+
+    try:
+        baseline, candidate = asyncio.run(run())
+    finally:
+        server.stop(None)
+    _report(
+        f"{packet_count} concurrent lookups of an unknown data format, RPCs",
+        baseline,
+        candidate,
+        "RPCs",
+    )
+
+
+def _dispatch_per_packet(envelope: open_data_pb2.Packet, handlers):
+    """Dispatching as previously done when deserializing and routing packets."""
+    packet = getattr(open_data_pb2, envelope.type + "Packet").FromString(
+        envelope.content
+    )
+    if isinstance(packet, open_data_pb2.PeriodicDataPacket):
+        logger.debug("Periodic packet received.")
+        return handlers[0]
+    if isinstance(packet, open_data_pb2.RowDataPacket):
+        logger.debug("Row packet received.")
+        return handlers[1]
+    if isinstance(packet, open_data_pb2.EventPacket):
+        logger.debug("Event packet received.")
+        return handlers[2]
+    if isinstance(packet, open_data_pb2.MarkerPacket):
+        logger.debug("Marker packet received.")
+        return handlers[3]
+    if isinstance(packet, open_data_pb2.MetadataPacket):
+        logger.debug("Metadata packet received.")
+        return handlers[4]
+    if isinstance(packet, open_data_pb2.ConfigurationPacket):
+        logger.debug("Config packet received.")
+        return handlers[5]
+    return None
+
+
+def bench_packet_dispatch(packet_count: int = 10_000, repeat: int = 5):
+    """Compare the per-packet type resolution against the PacketRegistry.
+
+    Packets are small markers and configurations, so the dispatch cost isn't hidden
+    by decoding large data packets.
+    """
+    packet_types = [
+        ("PeriodicData", open_data_pb2.PeriodicDataPacket),
+        ("RowData", open_data_pb2.RowDataPacket),
+        ("Event", open_data_pb2.EventPacket),
+        ("Marker", open_data_pb2.MarkerPacket),
+        ("Metadata", open_data_pb2.MetadataPacket),
+        ("Configuration", open_data_pb2.ConfigurationPacket),
+    ]
+    handlers = [object() for _ in packet_types]
+    registry = PacketRegistry()
+    for (packet_type, message_class), handler in zip(packet_types, handlers):
+        registry.register_bulk(packet_type, message_class, handler)
+    envelopes = [
+        open_data_pb2.Packet(
+            type=packet_type, content=open_data_pb2.MarkerPacket().SerializeToString()
+        )
+        for packet_type in ("Marker", "Configuration")
+    ] * (packet_count // 2)
+
+    def dispatch_registry():
+        for envelope in envelopes:
+            message_class = registry.message_class(envelope.type)
+            registry.handler(type(message_class.FromString(envelope.content)))
+
+    baseline = min(
+        timeit.repeat(
+            lambda: [_dispatch_per_packet(e, handlers) for e in envelopes],
+            number=1,
+            repeat=repeat,
+        )
+    )
+    candidate = min(timeit.repeat(dispatch_registry, number=1, repeat=repeat))
+    _report(
+        "Packet dispatch, per packet",
+        baseline / len(envelopes) * 1e9,
+        candidate / len(envelopes) * 1e9,
+        "ns",
+    )
+
+
+def bench_backlog_drain(
+    backlog_length: int = 400_000, limit: int = 200_000, chunk_size: int = 5000
+):
+    """Compare the longest pause of a drain of the packet backlog, routing excluded.
+
+    Previously the whole backlog was copied, sliced and pushed back in one go. It is
+    now taken from the head in chunks, yielding to the readers between them.
+    """
+    packets = [
+        BufferedPacket(open_data_pb2.PeriodicDataPacket, b"")
+        for _ in range(backlog_length)
+    ]
+
+    backlog = deque(packets)
+    start = time.perf_counter()
+    copied = list(backlog)
+    backlog.clear()
+    backlog.extendleft(copied[limit:][::-1])
+    copied = copied[:limit]
+    baseline = time.perf_counter() - start
+
+    chunked_backlog = PacketBacklog()
+    for packet in packets:
+        chunked_backlog.append(packet)
+    candidate = 0.0
+    for _ in range(limit // chunk_size):
+        start = time.perf_counter()
+        chunked_backlog.pop_chunk(chunk_size)
+        candidate = max(candidate, time.perf_counter() - start)
+    _report(
+        f"Draining {limit} of {backlog_length} backlogged packets, longest pause",
+        baseline * 1e3,
+        candidate * 1e3,
+        "ms",
+    )
+
+
+def _resident_memory() -> int:
+    """Resident memory of the process, in bytes."""
+    with open("/proc/self/statm", encoding="ascii") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def bench_buffered_packet_memory(
+    packet_count: int = 2000, parameter_count: int = 10, sample_count: int = 100
+):
+    """Compare the memory per sample of decoded and of encoded buffered packets.
+
+    Decoded packets are allocated by the protobuf runtime rather than by Python, so
+    their memory is measured from the resident memory of the process, which is only
+    available on Linux. Encoded packets are measured with `tracemalloc`.
+    """
+    content = build_periodic_packet(parameter_count, sample_count).SerializeToString()
+    sample_total = packet_count * parameter_count * sample_count
+
+    gc.collect()
+    before = _resident_memory()
+    decoded = [
+        open_data_pb2.PeriodicDataPacket.FromString(content)
+        for _ in range(packet_count)
+    ]
+    baseline = (_resident_memory() - before) / sample_total
+    del decoded
+
+    tracemalloc.start()
+    # Each buffered packet holds its own copy of the content, as read from a stream.
+    encoded = [
+        BufferedPacket(open_data_pb2.PeriodicDataPacket, bytes(bytearray(content)))
+        for _ in range(packet_count)
+    ]
+    candidate = tracemalloc.get_traced_memory()[0] / sample_total
+    tracemalloc.stop()
+    del encoded
+
+    logger.info(
+        "Buffered packet memory, %i packets of %i parameters x %i samples: "
+        "before %.1f bytes per sample, after %.1f bytes per sample, x%.1f less",
+        packet_count,
+        parameter_count,
+        sample_count,
+        baseline,
+        candidate,
+        baseline / candidate,
+    )
+
+
+def bench_decode_pool(
+    packet_count: int = 200,
+    parameter_count: int = 10,
+    worker_counts=(1, 2, 4, 8),
+):
+    """Compare decoding in the event loop against the decode pool, by worker count.
+
+    The speed up is bounded by the number of cores of the host.
+    """
+    content = build_periodic_packet(parameter_count).SerializeToString()
+    contents = [content] * packet_count
+
+    start = time.perf_counter()
+    decode_periodic_contents(contents)
+    baseline = time.perf_counter() - start
+
+    for workers in worker_counts:
+        pool = DecodePool(workers, batch_size=packet_count // (workers * 4) or 1)
+        # Start the workers before timing.
+        asyncio.run(pool.decode_periodic(contents[: workers * 4]))
+        start = time.perf_counter()
+        asyncio.run(pool.decode_periodic(contents))
+        candidate = time.perf_counter() - start
+        pool.shutdown()
+        _report(
+            f"Decoding {packet_count} periodic packets of {parameter_count} "
+            f"parameters x 1000 samples, {workers} workers on {os.cpu_count()} cores",
+            baseline * 1e3,
+            candidate * 1e3,
+            "ms",
+        )
+
+
+def main():
+    bench_periodic_decode()
+    bench_unary_rpcs()
+    bench_concurrent_lookups()
+    bench_packet_dispatch()
+    bench_backlog_drain()
+    bench_decode_pool()
+    try:
+        bench_buffered_packet_memory()
+    except OSError as e:
+        logger.info("Skipping buffered packet memory benchmark: %s", e)
+    try:
+        bench_sample_encoding()
+    except (ImportError, FileNotFoundError) as e:
+        logger.info("Skipping sample encoding benchmark, SQLRace unavailable: %s", e)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    main()
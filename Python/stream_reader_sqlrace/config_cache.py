@@ -0,0 +1,84 @@
+"""Fingerprints of the configs committed to SQLRace, kept across sessions."""
+
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+from ma.streaming.open_data.v1 import open_data_pb2
+
+logger = logging.getLogger(__name__)
+
+
+def normalise_identifier(identifier: str) -> str:
+    """Identifier with the StreamAPI app group if it has no app group."""
+    if ":" not in identifier:
+        return identifier + ":StreamAPI"
+    return identifier
+
+
+def config_fingerprint(packet: open_data_pb2.ConfigurationPacket) -> str:
+    """Digest of the content of a configuration packet."""
+    return hashlib.sha256(packet.SerializeToString(deterministic=True)).hexdigest()
+
+
+class ConfigFingerprintCache:
+    """Configs already committed, by fingerprint, with the channels they map to.
+
+    Each entry holds the config identifier, the channel id of each parameter and the
+    definition id and application group of each event, which is all the session
+    writer needs to use the committed config again without rebuilding it. If a path
+    is given, the entries are also saved to and loaded from that JSON file.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.configs: Dict[str, dict] = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self.configs = json.load(f)
+            except (OSError, ValueError):
+                logger.warning("Ignoring unreadable config cache %s", path)
+            logger.info("Loaded %i committed configs from %s", len(self), path)
+
+    def __len__(self) -> int:
+        return len(self.configs)
+
+    def get(self, fingerprint: str) -> Optional[dict]:
+        return self.configs.get(fingerprint)
+
+    def add(
+        self,
+        fingerprint: str,
+        config_identifier: str,
+        parameter_channel_ids: Dict[str, int],
+        events: Dict[str, List],
+    ) -> None:
+        """Record a committed config.
+
+        Args:
+            fingerprint: Fingerprint of the configuration packet.
+            config_identifier: Identifier of the committed config.
+            parameter_channel_ids: Channel id of each parameter identifier.
+            events: Definition id and application group of each event identifier.
+        """
+        self.configs[fingerprint] = {
+            "config_identifier": config_identifier,
+            "parameters": parameter_channel_ids,
+            "events": events,
+        }
+        if self.path is not None:
+            self._save()
+
+    def remove(self, fingerprint: str) -> None:
+        """Forget a config, e.g. once it is no longer in the database."""
+        if self.configs.pop(fingerprint, None) is not None and self.path is not None:
+            self._save()
+
+    def _save(self):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump(self.configs, f)
+        os.replace(temporary_path, self.path)
@@ -1,38 +1,355 @@
-from functools import cache
-from typing import List
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import grpc
 
 from ma.streaming.api.v1 import api_pb2
-from stream_api import StreamApi
+from stream_api import AsyncStreamApi
+from stream_reader_sqlrace.async_lru_cache import AsyncLruCache
+from stream_reader_sqlrace.data_format_store import DataFormatStore
+
+logger = logging.getLogger(__name__)
 
 
 class DataFormatCache:
+    """Cache of the data format lookups made against the Stream API.
+
+    Lookups are coroutines, so the RPCs made on a cache miss don't block the event
+    loop. Each kind of lookup is a bounded `AsyncLruCache`, so concurrent lookups of
+    the same unknown data format make a single RPC. The cache must be created within
+    the event loop it will be used in.
 
-    def __init__(self, data_source, grpc_address="localhost:13579"):
+    If a `DataFormatStore` is given, the mappings are also looked up in and saved to
+    it, so they survive restarts. A data format identifier may be reused by the
+    server for other parameters, so the first time a stored mapping is used in a run
+    it is checked against the server in the background, the stored value being used
+    meanwhile. Mappings which differ are replaced with the server's.
+    """
+
+    def __init__(
+        self,
+        data_source,
+        grpc_address="localhost:13579",
+        store: Optional[DataFormatStore] = None,
+        maxsize: int = 10_000,
+    ):
         self.data_source = data_source
         self.grpc_address = grpc_address
-        self.stream_api = StreamApi(self.grpc_address)
+        self.stream_api = AsyncStreamApi(self.grpc_address)
+        self.store = store
+        # Data formats whose parameter list was fetched from the server by this cache.
+        self.fetched_data_formats = set()
+        # Stored mappings checked against the server, or being checked, by key.
+        self.revalidated_data_formats = set()
+        self.revalidated_parameter_lists = set()
+        self.revalidated_events = set()
+        self._revalidation_tasks = set()
+        self.data_format_identifiers = AsyncLruCache(
+            self._load_data_format_identifier, maxsize
+        )
+        self.parameter_lists = AsyncLruCache(self._load_parameter_list, maxsize)
+        self.event_identifiers = AsyncLruCache(self._load_event_identifier, maxsize)
+        # Data formats the server has no event for, with the time they expire.
+        self.unknown_event_formats: Dict[int, float] = {}
+        self.negative_cache_ttl = 30.0  # seconds
 
-    @cache
-    def get_cached_data_format_identifier(
-        self, parameter_identifiers: List[str]
+    async def get_cached_data_format_identifier(
+        self, parameter_identifiers: Iterable[str]
     ) -> int:
+        key = tuple(parameter_identifiers)
+        data_format_identifier = await self.data_format_identifiers.get(key)
+        if self.store is not None and key not in self.revalidated_parameter_lists:
+            self.revalidated_parameter_lists.add(key)
+            self._revalidate(self._revalidate_data_format_identifier(key))
+        return data_format_identifier
+
+    async def _load_data_format_identifier(self, key: Tuple[str, ...]) -> int:
+        if self.store is not None:
+            data_format_identifier = self.store.get_data_format_identifier(key)
+            if data_format_identifier is not None:
+                return data_format_identifier
+        data_format_identifier = await self._fetch_data_format_identifier(key)
+        if self.store is not None:
+            self.store.put_parameter_list(data_format_identifier, key)
+        return data_format_identifier
+
+    async def _fetch_data_format_identifier(self, key: Tuple[str, ...]) -> int:
+        self.revalidated_parameter_lists.add(key)
         data_format_manager_stub = self.stream_api.data_format_manager_service_stub
         data_format_identifier_response = (
-            data_format_manager_stub.GetParameterDataFormatId(
+            await data_format_manager_stub.GetParameterDataFormatId(
                 api_pb2.GetParameterDataFormatIdRequest(
-                    data_source=self.data_source, parameters=parameter_identifiers
+                    data_source=self.data_source, parameters=key
                 )
             )
         )
         return data_format_identifier_response.data_format_identifier
 
-    @cache
-    def get_cached_parameter_list(self, data_format_identifier: int) -> List[str]:
+    async def get_cached_parameter_list(
+        self, data_format_identifier: int, column_count: Optional[int] = None
+    ) -> List[str]:
+        """Get the parameter identifiers of a data format.
+
+        Args:
+            data_format_identifier: Data format identifier.
+            column_count: Number of columns of the packet being decoded, if known. A
+                cached list of another length is out of date, so it is invalidated and
+                fetched again.
+
+        Returns:
+            Parameter identifiers of the data format.
+        """
+        parameter_list = await self.parameter_lists.get(data_format_identifier)
+        if (
+            self.store is not None
+            and data_format_identifier not in self.revalidated_data_formats
+        ):
+            self.revalidated_data_formats.add(data_format_identifier)
+            self._revalidate(self._revalidate_parameter_list(data_format_identifier))
+        if (
+            column_count is not None
+            and len(parameter_list) != column_count
+            and data_format_identifier not in self.fetched_data_formats
+        ):
+            logger.warning(
+                "Cached data format %i has %i parameters but packet has %i columns, "
+                "fetching it again.",
+                data_format_identifier,
+                len(parameter_list),
+                column_count,
+            )
+            self.invalidate(data_format_identifier)
+            parameter_list = await self.parameter_lists.get(data_format_identifier)
+        return parameter_list
+
+    async def _load_parameter_list(self, data_format_identifier: int) -> List[str]:
+        if self.store is not None:
+            parameter_list = self.store.get_parameter_list(data_format_identifier)
+            if parameter_list is not None:
+                return parameter_list
+        parameter_list = await self._fetch_parameter_list(data_format_identifier)
+        if self.store is not None:
+            self.store.put_parameter_list(data_format_identifier, parameter_list)
+        return parameter_list
+
+    async def _fetch_parameter_list(self, data_format_identifier: int) -> List[str]:
+        self.revalidated_data_formats.add(data_format_identifier)
         data_format_manager_stub = self.stream_api.data_format_manager_service_stub
-        param_list_response = data_format_manager_stub.GetParametersList(
+        param_list_response = await data_format_manager_stub.GetParametersList(
             api_pb2.GetParametersListRequest(
                 data_source=self.data_source,
                 data_format_identifier=data_format_identifier,
             )
         )
+        self.fetched_data_formats.add(data_format_identifier)
         return list(param_list_response.parameters)
+
+    def _revalidate(self, coroutine) -> None:
+        task = asyncio.ensure_future(coroutine)
+        self._revalidation_tasks.add(task)
+        task.add_done_callback(self._revalidation_tasks.discard)
+
+    async def _revalidate_parameter_list(self, data_format_identifier: int) -> None:
+        """Replace the parameter list of a data format if the server's differs."""
+        if data_format_identifier in self.fetched_data_formats:
+            return
+        try:
+            parameter_list = await self._fetch_parameter_list(data_format_identifier)
+        except grpc.aio.AioRpcError as e:
+            logger.warning(
+                "Failed to check data format %i against the server: %s",
+                data_format_identifier,
+                e.details(),
+            )
+            return
+        previous = self.parameter_lists.peek(data_format_identifier)
+        if previous == parameter_list:
+            return
+        logger.warning(
+            "Stored data format %i differs from the server's, replacing it.",
+            data_format_identifier,
+        )
+        if (
+            previous is not None
+            and self.data_format_identifiers.peek(tuple(previous))
+            == data_format_identifier
+        ):
+            self.data_format_identifiers.pop(tuple(previous))
+        self.parameter_lists.put(data_format_identifier, parameter_list)
+        self.data_format_identifiers.put(tuple(parameter_list), data_format_identifier)
+        self.store.put_parameter_list(data_format_identifier, parameter_list)
+
+    async def _revalidate_data_format_identifier(self, key: Tuple[str, ...]) -> None:
+        """Replace the data format of a parameter list if the server's differs."""
+        previous = self.data_format_identifiers.peek(key)
+        try:
+            data_format_identifier = await self._fetch_data_format_identifier(key)
+        except grpc.aio.AioRpcError as e:
+            logger.warning(
+                "Failed to check the data format of %i parameters against the "
+                "server: %s",
+                len(key),
+                e.details(),
+            )
+            return
+        if previous == data_format_identifier:
+            return
+        logger.warning(
+            "Stored data format %s of %i parameters differs from the server's %i, "
+            "replacing it.",
+            previous,
+            len(key),
+            data_format_identifier,
+        )
+        self.data_format_identifiers.put(key, data_format_identifier)
+        self.store.put_parameter_list(data_format_identifier, list(key))
+
+    async def get_cached_event_identifier(
+        self, data_format_identifier: int
+    ) -> Optional[str]:
+        """Get the event identifier of an event data format.
+
+        Data formats the server does not know are cached too, for
+        `negative_cache_ttl` seconds, so they are not looked up for every packet.
+
+        Returns:
+            The event identifier, or None if the data format is unknown.
+        """
+        expiry = self.unknown_event_formats.get(data_format_identifier)
+        if expiry is not None and time.monotonic() < expiry:
+            return None
+        event_identifier = await self.event_identifiers.get(data_format_identifier)
+        if (
+            self.store is not None
+            and event_identifier is not None
+            and data_format_identifier not in self.revalidated_events
+        ):
+            self.revalidated_events.add(data_format_identifier)
+            self._revalidate(self._revalidate_event_identifier(data_format_identifier))
+        return event_identifier
+
+    async def _load_event_identifier(
+        self, data_format_identifier: int
+    ) -> Optional[str]:
+        if self.store is not None:
+            event_identifier = self.store.get_event_identifier(data_format_identifier)
+            if event_identifier is not None:
+                return event_identifier
+
+        event_identifier = await self._fetch_event_identifier(data_format_identifier)
+        if event_identifier == "":
+            logger.warning("No event found for data format %i.", data_format_identifier)
+            self.unknown_event_formats[data_format_identifier] = (
+                time.monotonic() + self.negative_cache_ttl
+            )
+            return None
+        self.unknown_event_formats.pop(data_format_identifier, None)
+        if self.store is not None:
+            self.store.put_event_identifier(data_format_identifier, event_identifier)
+        return event_identifier
+
+    async def _fetch_event_identifier(self, data_format_identifier: int) -> str:
+        """Get the event identifier of a data format from the server, "" if unknown."""
+        self.revalidated_events.add(data_format_identifier)
+        data_format_manager_stub = self.stream_api.data_format_manager_service_stub
+        try:
+            event_response = await data_format_manager_stub.GetEvent(
+                api_pb2.GetEventRequest(
+                    data_source=self.data_source,
+                    data_format_identifier=data_format_identifier,
+                )
+            )
+            event_identifier = event_response.event
+        except grpc.aio.AioRpcError as e:
+            if e.code() not in (
+                grpc.StatusCode.NOT_FOUND,
+                grpc.StatusCode.INVALID_ARGUMENT,
+            ):
+                raise
+            event_identifier = ""
+        return event_identifier
+
+    async def _revalidate_event_identifier(self, data_format_identifier: int) -> None:
+        """Replace the event identifier of a data format if the server's differs."""
+        try:
+            event_identifier = await self._fetch_event_identifier(
+                data_format_identifier
+            )
+        except grpc.aio.AioRpcError as e:
+            logger.warning(
+                "Failed to check event data format %i against the server: %s",
+                data_format_identifier,
+                e.details(),
+            )
+            return
+        if self.event_identifiers.peek(data_format_identifier) == event_identifier:
+            return
+        logger.warning(
+            "Stored event data format %i differs from the server's, replacing it.",
+            data_format_identifier,
+        )
+        if event_identifier == "":
+            self.event_identifiers.pop(data_format_identifier)
+            self.store.invalidate(data_format_identifier)
+        else:
+            self.event_identifiers.put(data_format_identifier, event_identifier)
+            self.store.put_event_identifier(data_format_identifier, event_identifier)
+
+    async def warm_up_events(self, data_format_identifiers: Iterable[int]) -> None:
+        """Look up all the event data formats not cached yet, concurrently."""
+        await asyncio.gather(
+            *[
+                self.get_cached_event_identifier(data_format_identifier)
+                for data_format_identifier in set(data_format_identifiers)
+                if data_format_identifier not in self.event_identifiers
+            ]
+        )
+
+    def warm_up(self) -> None:
+        """Load all the mappings saved in the store, if any, into memory."""
+        if self.store is None:
+            return
+        parameter_lists, event_identifiers = self.store.load_all()
+        for data_format_identifier, parameter_list in parameter_lists.items():
+            self.parameter_lists.put(data_format_identifier, parameter_list)
+            self.data_format_identifiers.put(
+                tuple(parameter_list), data_format_identifier
+            )
+        for data_format_identifier, event_identifier in event_identifiers.items():
+            self.event_identifiers.put(data_format_identifier, event_identifier)
+        logger.info(
+            "Loaded %i data formats and %i events from %s",
+            len(parameter_lists),
+            len(event_identifiers),
+            self.store.path,
+        )
+
+    def invalidate(self, data_format_identifier: int) -> None:
+        """Forget everything cached for a data format, in memory and in the store."""
+        parameter_list = self.parameter_lists.pop(data_format_identifier)
+        if parameter_list is not None:
+            key = tuple(parameter_list)
+            if self.data_format_identifiers.peek(key) == data_format_identifier:
+                self.data_format_identifiers.pop(key)
+        self.event_identifiers.pop(data_format_identifier)
+        if self.store is not None:
+            self.store.invalidate(data_format_identifier)
+
+    def log_statistics(self) -> None:
+        for name, cache in (
+            ("Data format identifier", self.data_format_identifiers),
+            ("Parameter list", self.parameter_lists),
+            ("Event identifier", self.event_identifiers),
+        ):
+            logger.info(
+                "%s cache: %i entries, %i hits, %i misses, %i coalesced, "
+                "hit ratio %.3f",
+                name,
+                len(cache),
+                cache.hits,
+                cache.misses,
+                cache.coalesced,
+                cache.hit_ratio,
+            )
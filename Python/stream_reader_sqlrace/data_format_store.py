@@ -0,0 +1,199 @@
+"""Append-only store of data format mappings, kept on disk across restarts."""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_PARAMETERS = b"P"
+_EVENT = b"E"
+_INVALIDATED = b"X"
+# Longest possible "<kind> <data format identifier> <key> " record header.
+_HEADER_LENGTH = 96
+
+
+def parameters_digest(parameter_identifiers: List[str]) -> str:
+    """Digest identifying a list of parameter identifiers, order included."""
+    return hashlib.sha1("\n".join(parameter_identifiers).encode()).hexdigest()
+
+
+class DataFormatStore:
+    """Data format mappings of one data source, stored in an append-only file.
+
+    Each line of the file is a record `<kind> <data format identifier> <key> <JSON>`:
+    `P` records hold the parameter list of a data format, keyed by its digest, `E`
+    records hold the identifier of an event data format, and `X` records invalidate
+    whatever was previously stored for a data format. Later records supersede the
+    earlier ones.
+
+    The file is memory mapped and indexed on first use. The index only holds the
+    offsets of the records, so their payloads are decoded when they are looked up.
+    """
+
+    def __init__(self, directory: str, data_source: str):
+        os.makedirs(directory, exist_ok=True)
+        file_name = re.sub(r"[^\w.-]", "_", data_source) + ".dataformats"
+        self.path = os.path.join(directory, file_name)
+        # Data format identifier to the (start, end, digest) of its parameter list.
+        self._parameter_records: Dict[int, Tuple[int, int, str]] = None
+        self._event_records: Dict[int, Tuple[int, int]] = {}
+        self._data_formats_by_digest: Dict[str, int] = {}
+        self._mmap: Optional[mmap.mmap] = None
+        self._size = 0
+
+    def _load_index(self):
+        if self._parameter_records is not None:
+            return
+        self._parameter_records = {}
+        if not os.path.exists(self.path):
+            return
+        self._remap()
+        start = 0
+        while start < self._size:
+            end = self._mmap.find(b"\n", start)
+            if end == -1:
+                # Drop the incomplete record left by an interrupted write.
+                logger.warning(
+                    "Truncating incomplete record at %i in %s", start, self.path
+                )
+                self._mmap.close()
+                self._mmap = None
+                os.truncate(self.path, start)
+                self._remap()
+                break
+            header = self._mmap[start : min(end, start + _HEADER_LENGTH)]
+            try:
+                kind, data_format_identifier, key, _ = header.split(b" ", 3)
+                self._index_record(kind, int(data_format_identifier), key, start, end)
+            except ValueError:
+                logger.warning("Skipping corrupt record at %i in %s", start, self.path)
+            start = end + 1
+        logger.info(
+            "Indexed %i data formats and %i events from %s",
+            len(self._parameter_records),
+            len(self._event_records),
+            self.path,
+        )
+
+    def _remap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._size = os.path.getsize(self.path)
+        if self._size == 0:
+            return
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _index_record(
+        self, kind: bytes, data_format_identifier: int, key: bytes, start: int, end: int
+    ):
+        if kind == _PARAMETERS:
+            self._forget(data_format_identifier)
+            digest = key.decode()
+            self._parameter_records[data_format_identifier] = (start, end, digest)
+            self._data_formats_by_digest[digest] = data_format_identifier
+        elif kind == _EVENT:
+            self._event_records[data_format_identifier] = (start, end)
+        elif kind == _INVALIDATED:
+            self._forget(data_format_identifier)
+            self._event_records.pop(data_format_identifier, None)
+        else:
+            raise ValueError(f"Unknown record kind {kind}")
+
+    def _forget(self, data_format_identifier: int):
+        record = self._parameter_records.pop(data_format_identifier, None)
+        if (
+            record is not None
+            and self._data_formats_by_digest.get(record[2]) == data_format_identifier
+        ):
+            del self._data_formats_by_digest[record[2]]
+
+    def _read_payload(self, start: int, end: int):
+        if end > self._size:
+            self._remap()
+        record = self._mmap[start:end]
+        return json.loads(record.split(b" ", 3)[3])
+
+    def _append(self, kind: bytes, data_format_identifier: int, key: str, payload):
+        self._load_index()
+        record = b" ".join(
+            [
+                kind,
+                str(data_format_identifier).encode(),
+                key.encode(),
+                json.dumps(payload).encode(),
+            ]
+        )
+        with open(self.path, "ab") as f:
+            start = f.tell()
+            f.write(record + b"\n")
+        self._index_record(
+            kind, data_format_identifier, key.encode(), start, start + len(record)
+        )
+
+    def get_parameter_list(self, data_format_identifier: int) -> Optional[List[str]]:
+        self._load_index()
+        record = self._parameter_records.get(data_format_identifier)
+        if record is None:
+            return None
+        return self._read_payload(record[0], record[1])
+
+    def get_data_format_identifier(
+        self, parameter_identifiers: List[str]
+    ) -> Optional[int]:
+        self._load_index()
+        return self._data_formats_by_digest.get(
+            parameters_digest(parameter_identifiers)
+        )
+
+    def get_event_identifier(self, data_format_identifier: int) -> Optional[str]:
+        self._load_index()
+        record = self._event_records.get(data_format_identifier)
+        if record is None:
+            return None
+        return self._read_payload(*record)
+
+    def put_parameter_list(
+        self, data_format_identifier: int, parameter_identifiers: List[str]
+    ):
+        self._append(
+            _PARAMETERS,
+            data_format_identifier,
+            parameters_digest(parameter_identifiers),
+            list(parameter_identifiers),
+        )
+
+    def put_event_identifier(self, data_format_identifier: int, event_identifier: str):
+        self._append(_EVENT, data_format_identifier, "-", event_identifier)
+
+    def invalidate(self, data_format_identifier: int):
+        """Drop everything stored for a data format."""
+        self._append(_INVALIDATED, data_format_identifier, "-", None)
+
+    def load_all(self) -> Tuple[Dict[int, List[str]], Dict[int, str]]:
+        """Decode all the stored mappings.
+
+        Returns:
+            The parameter lists and the event identifiers, by data format identifier.
+        """
+        self._load_index()
+        parameter_lists = {
+            data_format_identifier: self._read_payload(record[0], record[1])
+            for data_format_identifier, record in self._parameter_records.items()
+        }
+        event_identifiers = {
+            data_format_identifier: self._read_payload(start, end)
+            for data_format_identifier, (start, end) in self._event_records.items()
+        }
+        return parameter_lists, event_identifiers
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
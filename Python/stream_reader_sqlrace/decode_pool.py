@@ -0,0 +1,128 @@
+"""Decoding of periodic data packets in worker processes."""
+
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, NamedTuple, Tuple
+
+from ma.streaming.open_data.v1 import open_data_pb2
+from stream_reader_sqlrace.packet_decoder import (
+    SampleBlock,
+    concatenate_blocks,
+    decode_periodic_packet,
+)
+
+
+class DecodedGroup(NamedTuple):
+    """Decoded samples of periodic data packets sharing the same columns.
+
+    Attributes:
+        data_format_identifier: Data format identifier of the packets, 0 if they
+            list their parameter identifiers instead.
+        parameter_identifiers: Parameter identifiers listed by the packets, empty if
+            they have a data format identifier.
+        indices: Indices of the packets in the decoded batch, in order.
+        block: Samples of the packets, stacked.
+    """
+
+    data_format_identifier: int
+    parameter_identifiers: Tuple[str, ...]
+    indices: List[int]
+    block: SampleBlock
+
+
+def decode_periodic_contents(
+    contents: List[bytes], block_size: int = 100
+) -> List[DecodedGroup]:
+    """Decode the content of periodic data packets, grouped by their columns.
+
+    This runs in the worker processes, so it only takes and returns picklable values.
+
+    Args:
+        contents: Content of PeriodicDataPacket envelopes.
+        block_size: Most packets stacked into a single group.
+
+    Returns:
+        Groups of packets with the same data format and column count, in order.
+    """
+    groups = defaultdict(list)
+    for index, content in enumerate(contents):
+        packet = open_data_pb2.PeriodicDataPacket.FromString(content)
+        data_format = packet.data_format
+        parameter_identifiers = ()
+        if data_format.data_format_identifier == 0:
+            parameter_identifiers = tuple(
+                data_format.parameter_identifiers.parameter_identifiers
+            )
+        key = (
+            data_format.data_format_identifier,
+            parameter_identifiers,
+            len(packet.columns),
+        )
+        groups[key].append((index, packet))
+
+    decoded = []
+    for (data_format_identifier, parameter_identifiers, _), group in groups.items():
+        for i in range(0, len(group), block_size):
+            run = group[i : i + block_size]
+            decoded.append(
+                DecodedGroup(
+                    data_format_identifier,
+                    parameter_identifiers,
+                    [index for index, _ in run],
+                    concatenate_blocks(
+                        [decode_periodic_packet(packet) for _, packet in run]
+                    ),
+                )
+            )
+    return decoded
+
+
+class DecodePool:
+    """Pool of worker processes decoding periodic data packets.
+
+    Protobuf parsing and sample extraction take most of the time of the reader, and
+    only use one core within the event loop. The pool decodes batches of packet
+    contents on the other cores, so the event loop only routes and writes the
+    decoded samples.
+
+    Attributes:
+        workers: Number of worker processes.
+        batch_size: Most packets decoded by a worker in one task.
+        block_size: Most packets stacked into a single decoded group.
+    """
+
+    def __init__(self, workers: int, batch_size: int = 500, block_size: int = 100):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.executor = ProcessPoolExecutor(workers)
+
+    async def decode_periodic(self, contents: List[bytes]) -> List[DecodedGroup]:
+        """Decode the content of periodic data packets across the workers.
+
+        Returns:
+            Groups of packets with the same data format and column count, with the
+            indices of their packets in `contents`.
+        """
+        loop = asyncio.get_running_loop()
+        starts = range(0, len(contents), self.batch_size)
+        results = await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    self.executor,
+                    decode_periodic_contents,
+                    contents[start : start + self.batch_size],
+                    self.block_size,
+                )
+                for start in starts
+            ]
+        )
+        return [
+            group._replace(indices=[start + index for index in group.indices])
+            for start, groups in zip(starts, results)
+            for group in groups
+        ]
+
+    def shutdown(self) -> None:
+        self.executor.shutdown()
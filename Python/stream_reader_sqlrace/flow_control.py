@@ -0,0 +1,99 @@
+"""Credit based flow control between the packet reader and the writer stage."""
+
+import asyncio
+import time
+from typing import Callable, Optional
+
+
+class CreditGate:
+    """Credits the packet reader needs to pull packets, granted by the drain rate.
+
+    Each byte of the packets waiting in the backlog holds a credit. The number of
+    credits is the number of bytes the writer stage drains in `window` seconds,
+    measured as an exponentially weighted moving average and bounded by
+    `min_credits` and `max_credits`, so the memory held by the backlog stays bounded
+    and follows how fast the session is actually written. The reader waits while no
+    credit is left, and resumes as soon as a drain grants some.
+
+    The gate must be created and used within a single event loop.
+
+    Attributes:
+        outstanding: Function returning the number of bytes holding credit.
+        min_credits: Least number of credits, whatever the drain rate.
+        max_credits: Most number of credits, whatever the drain rate.
+        window: Seconds of draining the credits are worth.
+        smoothing: Weight of the latest drain in the drain rate average.
+    """
+
+    def __init__(
+        self,
+        outstanding: Callable[[], int],
+        min_credits: int = 8 * 2**20,
+        max_credits: int = 512 * 2**20,
+        window: float = 2.0,
+        smoothing: float = 0.2,
+    ):
+        self.outstanding = outstanding
+        self.min_credits = min_credits
+        self.max_credits = max_credits
+        self.window = window
+        self.smoothing = smoothing
+        # Credits start at the maximum until a drain rate is measured.
+        self.credits = max_credits
+        self.drain_rate: Optional[float] = None  # bytes per second
+        # Number of times and seconds the reader waited for credit.
+        self.waits = 0
+        self.wait_time = 0.0
+        self.enabled = True
+        self._granted = asyncio.Event()
+        self._exhausted = asyncio.Event()
+
+    @property
+    def available(self) -> int:
+        return self.credits - self.outstanding()
+
+    async def acquire(self) -> None:
+        """Wait until there is credit left to pull more packets."""
+        if not self.enabled or self.available > 0:
+            return
+        self.waits += 1
+        start = time.monotonic()
+        self._exhausted.set()
+        while self.enabled and self.available <= 0:
+            self._granted.clear()
+            await self._granted.wait()
+        self.wait_time += time.monotonic() - start
+
+    def disable(self) -> None:
+        """Stop gating the reader, resuming it if it is waiting for credit."""
+        self.enabled = False
+        self._granted.set()
+
+    async def wait_exhausted(self, timeout: float) -> None:
+        """Wait until the reader runs out of credit, or for `timeout` seconds."""
+        try:
+            await asyncio.wait_for(self._exhausted.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def record_drain(self, nbytes: int, elapsed: float) -> None:
+        """Account for `nbytes` bytes of packets drained in `elapsed` seconds.
+
+        The drain rate and the credits are updated, and a waiting reader is resumed
+        if there is credit left.
+        """
+        if nbytes > 0 and elapsed > 0:
+            rate = nbytes / elapsed
+            if self.drain_rate is None:
+                self.drain_rate = rate
+            else:
+                self.drain_rate += self.smoothing * (rate - self.drain_rate)
+            self.credits = int(
+                min(
+                    max(self.drain_rate * self.window, self.min_credits),
+                    self.max_credits,
+                )
+            )
+        if self.available > 0:
+            self._exhausted.clear()
+            self._granted.set()
@@ -10,24 +10,49 @@ See Also:
 """
 
 import asyncio
+import contextlib
 import logging
 import os
 import signal
 import threading
+import time
 from datetime import datetime, timedelta
-from collections import deque
+from collections import Counter, defaultdict
+from typing import TYPE_CHECKING, Any, Callable, List, Optional, Set, Tuple
 import json
 
-import grpc
 import numpy as np
 from google.protobuf import wrappers_pb2
 
-from ma.streaming.api.v1 import api_pb2_grpc, api_pb2
+from ma.streaming.api.v1 import api_pb2
 from ma.streaming.open_data.v1 import open_data_pb2
-from stream_api import StreamApi
-from atlas_session_writer import AtlasSessionWriter
+from stream_api import (
+    AsyncStreamApi,
+    ChannelSettings,
+    channel_pool,
+    configure_channel_pool,
+)
+from stream_reader_sqlrace.config_cache import normalise_identifier
 from stream_reader_sqlrace.data_format_cache import DataFormatCache
+from stream_reader_sqlrace.data_format_store import DataFormatStore
+from stream_reader_sqlrace.decode_pool import DecodedGroup, DecodePool
+from stream_reader_sqlrace.flow_control import CreditGate
+from stream_reader_sqlrace.packet_backlog import BufferedPacket, PacketBacklog
+from stream_reader_sqlrace.packet_decoder import (
+    SampleBlock,
+    concatenate_blocks,
+    decode_periodic_packet,
+)
+from stream_reader_sqlrace.packet_dispatch import PacketRegistry
+from stream_reader_sqlrace.parked_packets import ParkedPackets
 from stream_reader_sqlrace.row_packet_processor import RowPacketProcessor
+from stream_reader_sqlrace.session_writer_actor import (
+    SessionWriterActor,
+    warn_on_failure,
+)
+
+if TYPE_CHECKING:
+    from atlas_session_writer import AtlasSessionWriter
 
 logger = logging.getLogger(__name__)
 
@@ -37,59 +62,183 @@ class StreamReaderSql:
 
     def __init__(self, sqlrace_server, sqlrace_database):
         self.last_processed = datetime.now()
-        self.packets_to_add = deque()
+        # Packets are buffered encoded, and only decoded when they are routed.
+        self.packets_to_add = PacketBacklog()
+        # Configuration, metadata and markers go through a lane of their own, applied
+        # as soon as they are read rather than behind the data backlog.
+        self.priority_packets = PacketBacklog()
+        self.priority_packet_classes = {
+            open_data_pb2.ConfigurationPacket,
+            open_data_pb2.MetadataPacket,
+            open_data_pb2.MarkerPacket,
+        }
+        # Packets waiting for the config of their parameters or events.
+        self.parked_packets = ParkedPackets()
         self.identifiers_with_missing_config = set()
         self.events_with_missing_config = set()
+        # When the first of the missing identifiers was found, and how long to collect
+        # missing identifiers for before submitting their config.
+        self.missing_config_since = None
+        self.missing_config_window = 2.0  # seconds
+        # Identifiers of the parameters and events whose config has been submitted to
+        # the session writer.
+        self.configured_identifiers = set()
+        self.configured_events = set()
+        # Parameter identifier lists whose parameters are all configured.
+        self.configured_parameter_lists = set()
         self.add_missing_config = True
         self.connection = None
         self.data_source = "Default"
         self.grpc_address = "localhost:13579"
-        self.stream_api = StreamApi(self.grpc_address)
+        self.stream_api: AsyncStreamApi = None
         self.session_key = None
         self.essentials_iterator = None
         self.packets_iterator = None
         self.main_task = None
         self.read_essentials_task = None
         self.schedule_process_queue_task = None
+        self.discover_streams_task = None
+        self.stream_discovery_interval = 5  # seconds
+        self.stream_discovery_requested: asyncio.Event = None
         self.is_session_complete = False
         self.sqlrace_server = sqlrace_server
         self.sqlrace_database = sqlrace_database
-        self.session_writer: AtlasSessionWriter = None
+        self.session_writer: "AtlasSessionWriter" = None
+        self.writer: SessionWriterActor = None
         self.row_packet_processor: RowPacketProcessor = None
         self.data_format_cache: DataFormatCache = None
-        self.packet_queue_limit = 200_000
+        # Directory to keep the data format mappings in across restarts, if any.
+        self.data_format_store_directory = None
+        # Directory to keep the fingerprints of the committed configs in, if any.
+        self.config_cache_directory = None
+        # Most memory the backlog of buffered packets may hold, in bytes.
+        self.backlog_memory_limit = 512 * 2**20
+        # Directory to spill the backlog beyond its memory limit to, if any. If there
+        # is none the packet reader is held back instead.
+        self.backlog_spill_directory = None
+        self.drain_chunk_size = 5000
         self.process_queue_interval = 10
+        # Credits the packet reader needs to pull packets, granted as the backlog is
+        # drained. Created in `main`.
+        self.credit_gate: CreditGate = None
+        # Number of commands the session writer may have pending before the backlog
+        # drain waits for it to catch up.
+        self.writer_pending_limit = 2000
         self.terminate = threading.Event()
+        # Packet types and streams to record, or None to record all of them.
+        self.packet_types: Optional[Set[str]] = None
+        self.streams: Optional[Set[str]] = None
+        # Number of packets discarded, by reason.
+        self.discarded_packets = Counter()
+        # Handlers of the packet types, more can be registered before running.
+        self.packet_registry = PacketRegistry()
+        self.packet_registry.register_bulk(
+            "PeriodicData",
+            open_data_pb2.PeriodicDataPacket,
+            self.handle_periodic_packets,
+        )
+        self.packet_registry.register_bulk(
+            "RowData", open_data_pb2.RowDataPacket, self.handle_row_packets
+        )
+        self.packet_registry.register_bulk(
+            "Event", open_data_pb2.EventPacket, self.handle_event_packets
+        )
+        for packet_type, message_class, handler in (
+            ("Marker", open_data_pb2.MarkerPacket, self.handle_marker_packet),
+            ("Metadata", open_data_pb2.MetadataPacket, self.handle_metatdata_packet),
+            (
+                "Configuration",
+                open_data_pb2.ConfigurationPacket,
+                self.handle_configuration_packet,
+            ),
+        ):
+            self.packet_registry.register(packet_type, message_class, handler)
+        # Number of packet groups handled concurrently when routing a batch.
+        self.routing_workers = 8
+        # Number of periodic packets decoded and written together.
+        self.periodic_batch_size = 100
+        # Number of worker processes decoding the periodic data, 0 to decode it in
+        # the event loop.
+        self.decode_workers = 0
+        self.decode_pool: DecodePool = None
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        asyncio.run(self.async_stop())
+        # The reader is stopped at the end of `run`, within its event loop. This only
+        # ensures the background threads are not left running if it never got there.
+        if self.row_packet_processor is not None:
+            self.row_packet_processor.stop()
+        if self.writer is not None:
+            self.writer.stop()
+
+    async def run(self):
+        """Record the session, then write out the remaining packets and stop."""
+        self.stream_api = AsyncStreamApi(self.grpc_address)
+        try:
+            await self.main()
+        finally:
+            await self.async_stop()
+            await channel_pool.close_aio()
 
     async def async_stop(self):
-        while len(self.packets_to_add) > 0:
+        # Stop the background tasks first, so none of them routes packets or submits
+        # commands while the backlog is drained and the writer stopped.
+        background_tasks = [
+            task
+            for task in (
+                self.schedule_process_queue_task,
+                self.discover_streams_task,
+                self.read_essentials_task,
+            )
+            if task is not None
+        ]
+        for task in background_tasks:
+            task.cancel()
+        for task, result in zip(
+            background_tasks,
+            await asyncio.gather(*background_tasks, return_exceptions=True),
+        ):
+            if isinstance(result, Exception):
+                logger.error("Task %s failed.", task.get_name(), exc_info=result)
+        await self.process_priority_packets()
+        while len(self.packets_to_add) > 0 or len(self.parked_packets) > 0:
+            self.submit_missing_config(force=True)
             await self.process_queue()
+        self.packets_to_add.close()
+        if self.decode_pool is not None:
+            self.decode_pool.shutdown()
         if self.row_packet_processor is not None:
             self.row_packet_processor.stop()
+        if self.data_format_cache is not None:
+            self.data_format_cache.log_statistics()
+        self.packet_registry.log_unknown_types()
+        logger.info("Discarded packets: %s", dict(self.discarded_packets))
+        if self.credit_gate is not None:
+            logger.info(
+                "Packet reader waited for credit %i times, for %.1fs",
+                self.credit_gate.waits,
+                self.credit_gate.wait_time,
+            )
         # if the session writer is initialized and the session hasn't been closed yet.
         if (
             self.session_writer is not None
             and self.session_writer.sql_race_connection is not None
         ):
             session_info_response = (
-                self.stream_api.session_management_service_stub.GetSessionInfo(
+                await self.stream_api.session_management_service_stub.GetSessionInfo(
                     api_pb2.GetSessionInfoRequest(session_key=self.session_key)
                 )
             )
             self.is_session_complete = session_info_response.is_complete
-            self.session_writer.session.UpdateIdentifier(
-                session_info_response.identifier
-            )
-            self.session_writer.add_details("Data Source", self.data_source)
-            self.session_writer.close_session()
+            self.writer.submit("update_identifier", session_info_response.identifier)
+            self.writer.submit("add_details", "Data Source", self.data_source)
+            self.writer.submit("close_session")
+        if self.writer is not None:
+            self.writer.stop()
         close_session_response = (
-            self.stream_api.connection_manager_service_stub.CloseConnection(
+            await self.stream_api.connection_manager_service_stub.CloseConnection(
                 api_pb2.CloseConnectionRequest(connection=self.connection)
             )
         )
@@ -101,28 +250,23 @@ class StreamReaderSql:
     async def session_stop(self):
         # If the session is live, subscribe to the session stop notification
         if not self.is_session_complete:
-            async with grpc.aio.insecure_channel(self.grpc_address) as channel:
-                session_management_stub = api_pb2_grpc.SessionManagementServiceStub(
-                    channel
+            session_management_stub = self.stream_api.session_management_service_stub
+            async for (
+                stop_notification
+            ) in session_management_stub.GetSessionStopNotification(
+                api_pb2.GetSessionStopNotificationRequest(data_source=self.data_source)
+            ):
+                logger.debug(
+                    "Stop notification received for session: %s",
+                    stop_notification.session_key,
                 )
-                async for (
-                    stop_notification
-                ) in session_management_stub.GetSessionStopNotification(
-                    api_pb2.GetSessionStopNotificationRequest(
-                        data_source=self.data_source
-                    )
-                ):
-                    logger.debug(
-                        "Stop notification received for session: %s",
-                        stop_notification.session_key,
-                    )
-                    if stop_notification.session_key == self.session_key:
-                        break
+                if stop_notification.session_key == self.session_key:
+                    break
 
         while (
             datetime.now() - self.last_processed
             < timedelta(seconds=self.process_queue_interval + 5)
-        ) or (len(self.packets_to_add) > 0):
+        ) or (len(self.packets_to_add) > 0 or len(self.priority_packets) > 0):
             await asyncio.sleep(self.process_queue_interval + 10)
         logger.info("Finished processing remaining packets, terminating...")
         self.terminate_main_task()
@@ -130,6 +274,8 @@ class StreamReaderSql:
     def terminate_main_task(self, *_):
         logger.info("Terminating main task.")
         self.terminate.set()
+        self.stream_discovery_requested.set()
+        self.credit_gate.disable()
         self.essentials_iterator.cancel()
         self.packets_iterator.cancel()
         # self.main_task.cancel()
@@ -137,114 +283,132 @@ class StreamReaderSql:
 
     async def read_essentials(self):
         logger.info("Start reading essential packets")
-        async with grpc.aio.insecure_channel(self.grpc_address) as channel:
-            packet_reader_stub = api_pb2_grpc.PacketReaderServiceStub(channel)
-            essentials_iterator = packet_reader_stub.ReadEssentials(
-                api_pb2.ReadEssentialsRequest(connection=self.connection)
-            )
-            self.essentials_iterator = essentials_iterator
-            async for essentials_packet_response in essentials_iterator:
-                logger.debug("New essential packet received.")
-                await asyncio.gather(
-                    *[
-                        self.deserialize_new_packet(response.packet, True)
-                        for response in essentials_packet_response.response
-                    ]
-                )
-                await self.process_queue()
+        packet_reader_stub = self.stream_api.packet_reader_service_stub
+        essentials_iterator = packet_reader_stub.ReadEssentials(
+            api_pb2.ReadEssentialsRequest(connection=self.connection)
+        )
+        self.essentials_iterator = essentials_iterator
+        async for essentials_packet_response in essentials_iterator:
+            logger.debug("New essential packet received.")
+            for response in essentials_packet_response.response:
+                self.deserialize_new_packet(response.packet, True, response.stream)
+            # New streams usually publish their configuration first, so check for
+            # them straight away rather than at the next poll.
+            self.stream_discovery_requested.set()
+            await self.process_priority_packets()
 
     async def read_packets(self):
         while not self.terminate.is_set():
             logger.info("Start reading packets")
-            options = [("grpc.max_receive_message_length", 8 * 1024 * 1024)]
-            async with grpc.aio.insecure_channel(
-                self.grpc_address, options=options
-            ) as channel:
-                packet_reader_stub = api_pb2_grpc.PacketReaderServiceStub(channel)
-                packets_iterator = packet_reader_stub.ReadPackets(
-                    api_pb2.ReadPacketsRequest(connection=self.connection)
-                )
-                self.packets_iterator = packets_iterator
-                try:
-                    async for new_packet_response in packets_iterator:
-                        logger.debug("New packet received.")
-                        await asyncio.gather(
-                            *[
-                                self.deserialize_new_packet(response.packet, True)
-                                for response in new_packet_response.response
-                            ]
+            # The stream reuses the shared channel, so restarting it doesn't need a
+            # new connection.
+            packet_reader_stub = self.stream_api.packet_reader_service_stub
+            packets_iterator = packet_reader_stub.ReadPackets(
+                api_pb2.ReadPacketsRequest(connection=self.connection)
+            )
+            self.packets_iterator = packets_iterator
+            try:
+                async for new_packet_response in packets_iterator:
+                    logger.debug("New packet received.")
+                    for response in new_packet_response.response:
+                        self.deserialize_new_packet(
+                            response.packet, True, response.stream
                         )
-                        if len(self.packets_to_add) > self.packet_queue_limit * 2:
-                            # back off reading packets if we can't process it fast enough
-                            await asyncio.sleep(
-                                len(self.packets_to_add) / self.packet_queue_limit
-                            )
-                        if self.update_connection():
-                            logger.info("New stream found, restarting packet reader.")
-                            packets_iterator.cancel()
-                            break
-                except asyncio.CancelledError:
-                    pass
-
-    async def handle_packet_missing_config(self, packet, parameter_identifiers):
-        """Process the packet for missing config.
+                    await self.process_priority_packets()
+                    # Stop pulling from the stream until the backlog is drained
+                    # enough to grant credit again.
+                    await self.credit_gate.acquire()
+            except asyncio.CancelledError:
+                # Cancelled by `discover_streams` when the connection is replaced.
+                pass
+
+    async def discover_streams(self):
+        """Watch the session for new streams, off the packet reading path.
+
+        The session is polled every `stream_discovery_interval` seconds, or sooner if
+        `stream_discovery_requested` is set. When new streams are found the packet
+        reader is restarted on a connection including them.
+        """
+        while not self.terminate.is_set():
+            try:
+                await asyncio.wait_for(
+                    self.stream_discovery_requested.wait(),
+                    self.stream_discovery_interval,
+                )
+            except asyncio.TimeoutError:
+                pass
+            self.stream_discovery_requested.clear()
+            if self.terminate.is_set():
+                break
+            previous_connection = self.connection
+            if await self.update_connection():
+                logger.info("New stream found, restarting packet reader.")
+                self.packets_iterator.cancel()
+                await self.stream_api.connection_manager_service_stub.CloseConnection(
+                    api_pb2.CloseConnectionRequest(connection=previous_connection)
+                )
+
+    async def handle_packet_missing_config(self, packets, parameter_identifiers):
+        """Process the packets for missing config.
 
         Args:
-            packet: packet
-            parameter_identifiers: list of parameter identifiers within the packet
+            packets: packets, all with the same parameters
+            parameter_identifiers: list of parameter identifiers within the packets
 
         Returns:
             True if there is missing config.
         """
-        missing_config = False
-        for parameter_identifier in parameter_identifiers:
-            if len(parameter_identifier.split(":")) == 1:
-                parameter_identifier += ":StreamAPI"
-            if (
-                parameter_identifier
-                not in self.session_writer.parameter_channel_id_mapping.keys()
-            ):
-                self.identifiers_with_missing_config.add(parameter_identifier)
-                missing_config = True
-
-        if missing_config:
-            self.packets_to_add.appendleft(packet)
-            logger.debug("Missing config packet added to queue")
-
-        return missing_config
+        key = tuple(parameter_identifiers)
+        if key in self.configured_parameter_lists:
+            return False
+        missing_identifiers = {
+            parameter_identifier
+            for parameter_identifier in map(normalise_identifier, key)
+            if parameter_identifier not in self.configured_identifiers
+        }
+        if not missing_identifiers:
+            # Config is never removed, so the list doesn't need checking again.
+            self.configured_parameter_lists.add(key)
+            return False
+
+        self.identifiers_with_missing_config.update(missing_identifiers)
+        if self.missing_config_since is None:
+            self.missing_config_since = time.monotonic()
+        self.parked_packets.park(packets, missing_identifiers)
+        logger.debug("%i missing config packets parked", len(packets))
+        return True
 
     async def handle_event_packet_missing_config(
-        self, packet: open_data_pb2.EventPacket, event_identifier: str
+        self, packets: List[open_data_pb2.EventPacket], event_identifier: str
     ):
-        """Process the packet for missing config.
+        """Process the packets for missing config.
 
         Args:
-            packet: packet
-            event_identifier: event identifier within the packet
+            packets: packets, all of the same event
+            event_identifier: event identifier within the packets
 
         Returns:
             True if there is missing config.
         """
-        missing_config = False
-        if event_identifier not in self.session_writer.event_identifier_mapping.keys():
-            self.events_with_missing_config.add(event_identifier)
-            missing_config = True
-
-        if missing_config:
-            self.packets_to_add.appendleft(packet)
-            logger.debug("Missing config packet added to queue")
+        if event_identifier in self.configured_events:
+            return False
 
-        return missing_config
+        self.events_with_missing_config.add(event_identifier)
+        if self.missing_config_since is None:
+            self.missing_config_since = time.monotonic()
+        self.parked_packets.park(packets, [event_identifier])
+        logger.debug("%i missing config packets parked", len(packets))
+        return True
 
-    def update_connection(self):
+    async def update_connection(self):
         current_connection = (
-            self.stream_api.connection_manager_service_stub.GetConnection(
+            await self.stream_api.connection_manager_service_stub.GetConnection(
                 api_pb2.GetConnectionRequest(connection=self.connection)
-            ).details
-        )
+            )
+        ).details
 
         session_info_response = (
-            self.stream_api.session_management_service_stub.GetSessionInfo(
+            await self.stream_api.session_management_service_stub.GetSessionInfo(
                 api_pb2.GetSessionInfoRequest(session_key=self.session_key)
             )
         )
@@ -257,13 +421,11 @@ class StreamReaderSql:
                 current_connection.stream_offsets.append(offset)
                 missing_stream = True
 
-        # Recreate the connection if there are new streams
+        # Create a new connection if there are new streams. The previous connection
+        # is left open, so the packet reader can carry on until it is switched over.
         if missing_stream:
-            self.stream_api.connection_manager_service_stub.CloseConnection(
-                api_pb2.CloseConnectionRequest(connection=self.connection)
-            )
             connection_response = (
-                self.stream_api.connection_manager_service_stub.NewConnection(
+                await self.stream_api.connection_manager_service_stub.NewConnection(
                     api_pb2.NewConnectionRequest(details=current_connection)
                 )
             )
@@ -274,186 +436,491 @@ class StreamReaderSql:
 
     async def schedule_process_queue(self):
         while True:  # Terminated by setting terminate
-            await asyncio.sleep(self.process_queue_interval)
-            await self.process_queue()
-            while len(self.packets_to_add) > self.packet_queue_limit:
+            # Drain the backlog periodically, or as soon as the reader runs out of
+            # credit.
+            await self.credit_gate.wait_exhausted(self.process_queue_interval)
+            try:
                 await self.process_queue()
+            except Exception:  # pylint: disable=broad-exception-caught
+                # Nothing else drains the backlog, so keep going.
+                logger.exception("Failed to process the queue.")
+            if self.discarded_packets:
+                logger.info("Discarded packets: %s", dict(self.discarded_packets))
             if self.terminate.is_set():
                 break
 
-    async def process_queue(self):
-        missing_identifiers = list(self.identifiers_with_missing_config.copy())
+    def submit_missing_config(self, force: bool = False):
+        """Submit the config of the parameters and events found without one.
+
+        Missing identifiers are collected for `missing_config_window` seconds from
+        the first one found, so they are committed together in a single config.
+
+        Args:
+            force: Submit the missing config now, even if the window is still open.
+        """
+        if self.missing_config_since is None or (
+            not force
+            and time.monotonic() - self.missing_config_since
+            < self.missing_config_window
+        ):
+            return
+        self.missing_config_since = None
+        # Some of them may have been configured from the essentials stream since.
+        missing_identifiers = [
+            identifier
+            for identifier in self.identifiers_with_missing_config
+            if identifier not in self.configured_identifiers
+        ]
         self.identifiers_with_missing_config.clear()
-        missing_events = list(self.events_with_missing_config.copy())
+        missing_events = [
+            identifier
+            for identifier in self.events_with_missing_config
+            if identifier not in self.configured_events
+        ]
         self.events_with_missing_config.clear()
-        self.session_writer.add_missing_configration(
-            missing_identifiers, missing_events
-        )
+        if missing_identifiers or missing_events:
+            self.writer.submit(
+                "add_missing_configration", missing_identifiers, missing_events
+            )
+        self.configured_identifiers.update(missing_identifiers)
+        self.configured_events.update(missing_events)
+        self.release_parked_packets(missing_identifiers + missing_events)
+
+    def release_parked_packets(self, configured_identifiers: List[str]):
+        """Put the packets no longer missing config back at the head of the backlog."""
+        packets = self.parked_packets.release(configured_identifiers)
+        if packets:
+            logger.debug("%i parked packets released", len(packets))
+            # Packets parked by the decode pool are still buffered.
+            self.packets_to_add.push_front(
+                [
+                    (
+                        packet
+                        if isinstance(packet, BufferedPacket)
+                        else BufferedPacket.encode(packet)
+                    )
+                    for packet in packets
+                ]
+            )
 
-        packets = list(self.packets_to_add)
-        self.packets_to_add.clear()
-        self.packets_to_add.extendleft(packets[self.packet_queue_limit :][::-1])
-        packets = packets[: self.packet_queue_limit]
+    async def process_priority_packets(self):
+        """Route all the packets of the priority lane, in the order they were read."""
+        while len(self.priority_packets) > 0:
+            await self.route_packets(
+                [
+                    packet.decode()
+                    for packet in self.priority_packets.pop_chunk(
+                        len(self.priority_packets)
+                    )
+                ]
+            )
 
+    async def process_queue(self):
+        """Route the packets in the backlog.
+
+        The packets are taken in chunks of `drain_chunk_size`, yielding to the packet
+        readers between chunks. Packets parked for missing config are pushed back to
+        the head of the backlog, and their config is submitted before the next chunk.
+
+        Chunks are only routed while the session writer has fewer than
+        `writer_pending_limit` commands pending, so the drain rate granting credit to
+        the packet reader is the rate the session is actually written at.
+        """
+        remaining = len(self.packets_to_add)
         logger.info(
-            "Processing %i packets from queue. Remaining queue length: %i",
-            len(packets),
-            len(self.packets_to_add),
+            "Processing %i packets from queue, %.1f MB in memory and %.1f MB spilled",
+            remaining,
+            self.packets_to_add.nbytes / 2**20,
+            self.packets_to_add.spilled_nbytes / 2**20,
         )
+        while True:
+            self.submit_missing_config()
+            if remaining <= 0:
+                break
+            packets = self.packets_to_add.pop_chunk(
+                min(self.drain_chunk_size, remaining)
+            )
+            remaining -= len(packets)
+            start = time.monotonic()
+            if self.writer.pending > self.writer_pending_limit:
+                await self.writer.drained()
+            with self.drop_on_failure(len(packets), "packets of the backlog"):
+                await self.route_buffered_packets(packets)
+            self.credit_gate.record_drain(
+                sum(packet.nbytes for packet in packets), time.monotonic() - start
+            )
+            # Let the packet readers run between chunks.
+            await asyncio.sleep(0)
+
+    async def route_buffered_packets(self, packets: List[BufferedPacket]):
+        """Decode buffered packets and route them to their handlers.
 
-        await asyncio.gather(*[self.route_new_packet(packets) for packets in packets])
+        If there is a decode pool, the periodic data packets are decoded by its
+        workers while the other packets are routed. Row data packets are queued with
+        the memory they held while buffered, once the other packets are routed.
+        """
+        row_packets = [
+            packet
+            for packet in packets
+            if packet.message_class is open_data_pb2.RowDataPacket
+        ]
+        packets = [
+            packet
+            for packet in packets
+            if packet.message_class is not open_data_pb2.RowDataPacket
+        ]
+        if self.decode_pool is None:
+            await self.route_packets([packet.decode() for packet in packets])
+            await self.handle_buffered_row_packets(row_packets)
+            return
 
-    async def deserialize_new_packet(
-        self, new_packet: open_data_pb2.Packet, match_session_key: bool = False
+        periodic_packets = [
+            packet
+            for packet in packets
+            if packet.message_class is open_data_pb2.PeriodicDataPacket
+        ]
+        decoding = asyncio.ensure_future(
+            self.decode_pool.decode_periodic(
+                [packet.content for packet in periodic_packets]
+            )
+        )
+        await self.route_packets(
+            [
+                packet.decode()
+                for packet in packets
+                if packet.message_class is not open_data_pb2.PeriodicDataPacket
+            ]
+        )
+        await self.handle_buffered_row_packets(row_packets)
+        await self.handle_decoded_periodic_packets(periodic_packets, await decoding)
+
+    def deserialize_new_packet(
+        self,
+        new_packet: open_data_pb2.Packet,
+        match_session_key: bool = False,
+        stream: str = "",
     ):
         """Decodes new protobuf packets received from the Stream API.
 
+        Only the envelope is checked: the content is buffered encoded, and decoded
+        when it is routed. Discarded packets are counted in `discarded_packets`.
+        Packets of the `priority_packet_classes` are put in the priority lane, the
+        others in the data backlog.
+
         Args:
             new_packet: Protobuf packet from the open format specification
             match_session_key: True if we only handle packet that match `self.session_key`
+            stream: Stream the packet was read from, empty for the main stream.
         """
 
-        packet_type = new_packet.type
-        content = new_packet.content
-        session_key = new_packet.session_key
-
         self.last_processed = datetime.now()
 
-        # discard the packet if the session key does not match
-        if match_session_key and (session_key != self.session_key):
-            logger.info("Session key mismatch, packet discarded.")
+        if match_session_key and (new_packet.session_key != self.session_key):
+            self.discarded_packets["session key mismatch"] += 1
+            return
+        if self.packet_types is not None and new_packet.type not in self.packet_types:
+            self.discarded_packets["packet type not recorded"] += 1
             return
+        if self.streams is not None and stream and stream not in self.streams:
+            self.discarded_packets["stream not recorded"] += 1
+            return
+
+        # Packets of a type without a registered handler are discarded.
+        message_class = self.packet_registry.message_class(new_packet.type)
+        if message_class is None:
+            return
+
+        packet = BufferedPacket(message_class, new_packet.content)
+        if message_class in self.priority_packet_classes:
+            self.priority_packets.append(packet)
+        else:
+            self.packets_to_add.append(packet)
 
-        # try and deserializes the packet, if the packet type can be located.
-        # if we can't find a corresponding packet type, discard the packet.
+    @contextlib.contextmanager
+    def drop_on_failure(self, packet_count: int, description: str):
+        """Drop a group of packets whose handling fails, logging the error.
+
+        The packets are already out of the backlog, so their credits are granted
+        back. A failing group must not stop the drain, or the packet reader would
+        wait for credits forever.
+
+        Args:
+            packet_count: Number of packets in the group.
+            description: What the packets are, for the log.
+        """
         try:
-            packet_class = getattr(open_data_pb2, packet_type + "Packet")
-            packet = packet_class.FromString(content)
-        except AttributeError:
-            logger.debug(
-                "Unable to deserializes packet content for pack type %s", packet_type
+            yield
+        except Exception:  # pylint: disable=broad-exception-caught
+            self.discarded_packets["handling failed"] += packet_count
+            logger.exception(
+                "Failed to handle %i %s, dropped.", packet_count, description
             )
-            return
 
-        self.packets_to_add.append(packet)
+    async def route_packets(self, packets: List[Any]):
+        """Route a batch of packets to their handlers, grouped by class and data format.
 
-    async def route_new_packet(self, packet):
+        Each group is passed to its bulk handler in a single call, and at most
+        `routing_workers` groups are handled concurrently. Configuration packets are
+        handled first, so the data they describe finds its configuration.
+        """
         self.last_processed = datetime.now()
-        if isinstance(packet, open_data_pb2.PeriodicDataPacket):
-            logger.debug("Periodic packet received.")
-            await self.handle_periodic_packet(packet)
-        elif isinstance(packet, open_data_pb2.RowDataPacket):
-            logger.debug("Row packet received.")
-            await self.handle_row_packet(packet)
-        elif isinstance(packet, open_data_pb2.EventPacket):
-            logger.debug("Event packet received.")
-            await self.handle_event_packet(packet)
-        elif isinstance(packet, open_data_pb2.MarkerPacket):
-            logger.debug("Marker packet received.")
-            await self.handle_marker_packet(packet)
-        elif isinstance(packet, open_data_pb2.MetadataPacket):
-            logger.debug("Metadata packet received.")
-            await self.handle_metatdata_packet(packet)
-        elif isinstance(packet, open_data_pb2.ConfigurationPacket):
-            logger.debug("Config packet received.")
-            await self.handle_configuration_packet(packet)
-        else:
-            logger.info("Unknown packet type, discarded packet %s", packet.__class__)
+        groups = defaultdict(list)
+        for packet in packets:
+            data_format = getattr(packet, "data_format", None)
+            data_format_identifier = (
+                0 if data_format is None else data_format.data_format_identifier
+            )
+            groups[(type(packet), data_format_identifier)].append(packet)
+
+        for key in [
+            key for key in groups if key[0] is open_data_pb2.ConfigurationPacket
+        ]:
+            group = groups.pop(key)
+            with self.drop_on_failure(len(group), key[0].__name__):
+                await self.packet_registry.handler(key[0])(group)
+
+        # Resolve the event identifiers of new event data formats in one go.
+        await self.data_format_cache.warm_up_events(
+            data_format_identifier
+            for message_class, data_format_identifier in groups
+            if message_class is open_data_pb2.EventPacket
+            and data_format_identifier != 0
+        )
+
+        pending_groups = iter(groups.items())
+
+        async def route_groups():
+            for (message_class, _), group in pending_groups:
+                with self.drop_on_failure(len(group), message_class.__name__):
+                    await self.packet_registry.handler(message_class)(group)
+
+        await asyncio.gather(
+            *[route_groups() for _ in range(min(self.routing_workers, len(groups)))]
+        )
+
+    async def group_by_parameters(
+        self, packets: List[Any], column_count: Callable[[Any], int]
+    ) -> List[Tuple[List[str], List[Any]]]:
+        """Group data packets of the same data format by their parameter identifiers.
+
+        Args:
+            packets: Periodic or row data packets, all of the same data format.
+            column_count: Function returning the number of columns of a packet.
+
+        Returns:
+            The parameter identifiers and packets of each group.
+        """
+        data_format_identifier = packets[0].data_format.data_format_identifier
+        if data_format_identifier != 0:
+            parameter_identifiers = (
+                await self.data_format_cache.get_cached_parameter_list(
+                    data_format_identifier, column_count(packets[0])
+                )
+            )
+            return [(parameter_identifiers, packets)]
+
+        groups = defaultdict(list)
+        for packet in packets:
+            groups[
+                tuple(packet.data_format.parameter_identifiers.parameter_identifiers)
+            ].append(packet)
+        return [(list(key), group) for key, group in groups.items()]
 
     async def handle_configuration_packet(
         self, packet: open_data_pb2.ConfigurationPacket
     ):
-        # Create a corresponding config in atlas
-        self.session_writer.add_configration(packet)
-
-    async def handle_periodic_packet(self, packet: open_data_pb2.PeriodicDataPacket):
-        ##  Get the parameter identifier
-        if packet.data_format.data_format_identifier != 0:
-            data_format_identifier = packet.data_format.data_format_identifier
-            parameter_identifiers = self.data_format_cache.get_cached_parameter_list(
-                data_format_identifier
+        # Create a corresponding config in atlas. Only the identifiers the session
+        # writer mapped are configured: if the config already exists in the database
+        # its parameters and events are not mapped, so they get a generated config.
+        try:
+            parameter_identifiers, event_identifiers = await self.writer.call(
+                "add_configration", packet
             )
-        else:
-            parameter_identifiers = (
-                packet.data_format.parameter_identifiers.parameter_identifiers
+        except Exception:  # pylint: disable=broad-exception-caught
+            # Logged by the session writer, none of the config is mapped.
+            parameter_identifiers, event_identifiers = [], []
+        unmapped_count = (
+            len(packet.parameter_definitions)
+            + len(packet.event_definitions)
+            - len(parameter_identifiers)
+            - len(event_identifiers)
+        )
+        if unmapped_count > 0:
+            logger.warning(
+                "%i parameters and events of config %s not mapped in the session.",
+                unmapped_count,
+                packet.config_id,
             )
+        self.configured_identifiers.update(parameter_identifiers)
+        self.configured_events.update(event_identifiers)
+        self.release_parked_packets(parameter_identifiers + event_identifiers)
+
+    async def handle_periodic_packets(
+        self, packets: List[open_data_pb2.PeriodicDataPacket]
+    ):
+        for parameter_identifiers, group in await self.group_by_parameters(
+            packets, lambda packet: len(packet.columns)
+        ):
+            for packet in group:
+                assert len(parameter_identifiers) == len(packet.columns), (
+                    "The number of parameter identifiers should match the number of "
+                    "columns"
+                )
+
+            # add config if there are no config for the parameters
+            if self.add_missing_config:
+                if await self.handle_packet_missing_config(
+                    group, parameter_identifiers
+                ):
+                    # If there are missing config then the packets are added to the
+                    # queue and we move on
+                    continue
+
+            ## Get the periodic data, with timestamps already in SQLRace format, and
+            ## add it to the session in blocks of several packets.
+            for i in range(0, len(group), self.periodic_batch_size):
+                block = concatenate_blocks(
+                    [
+                        decode_periodic_packet(packet)
+                        for packet in group[i : i + self.periodic_batch_size]
+                    ]
+                )
+                self.write_periodic_block(parameter_identifiers, block)
 
-        assert len(parameter_identifiers) == len(
-            packet.columns
+    async def handle_decoded_periodic_packets(
+        self, packets: List[BufferedPacket], groups: List[DecodedGroup]
+    ):
+        """Write periodic data packets decoded by the decode pool.
+
+        Args:
+            packets: Buffered periodic data packets, as sent to the decode pool.
+            groups: Decoded groups of the packets.
+        """
+        for group in groups:
+            with self.drop_on_failure(len(group.indices), "PeriodicDataPacket"):
+                await self.handle_decoded_periodic_group(packets, group)
+
+    async def handle_decoded_periodic_group(
+        self, packets: List[BufferedPacket], group: DecodedGroup
+    ):
+        """Write a group of periodic data packets decoded by the decode pool."""
+        column_count = group.block.values.shape[1]
+        if group.data_format_identifier != 0:
+            parameter_identifiers = (
+                await self.data_format_cache.get_cached_parameter_list(
+                    group.data_format_identifier, column_count
+                )
+            )
+        else:
+            parameter_identifiers = list(group.parameter_identifiers)
+        assert (
+            len(parameter_identifiers) == column_count
         ), "The number of parameter identifiers should match the number of columns"
 
         # add config if there are no config for the parameters
         if self.add_missing_config:
-            if await self.handle_packet_missing_config(packet, parameter_identifiers):
-                # If there are missing config then the packet is added to the queue and
-                # we return early
+            if await self.handle_packet_missing_config(
+                [packets[index] for index in group.indices],
+                parameter_identifiers,
+            ):
                 return
 
-        ## Get the periodic data
-        start_time = packet.start_time
-        interval = packet.interval
-        data = []
-        status = []
-        for column, parameter_identifier in zip(packet.columns, parameter_identifiers):
-            samples = getattr(column, column.WhichOneof("list")).samples
-            data.append([s.value for s in samples])
-            status.append([s.status for s in samples])
-
-        ## Add the data to the session
-        # Create timestamps and convert them to SQLRace format.
-        timestamps_ns = [start_time + interval * i for i in range(len(data[0]))]
-        timestamps_sqlrace = np.mod(timestamps_ns, np.int64(1e9 * 3600 * 24))
-        # add the data to the session
-        for parameter_identifier, data_for_param in zip(parameter_identifiers, data):
-            if not await asyncio.to_thread(
-                self.session_writer.add_data,
-                parameter_identifier,
-                data_for_param,
-                timestamps_sqlrace,
-            ):
-                logger.warning(
-                    "Failed to add data for parameter %s", parameter_identifier
-                )
+        self.write_periodic_block(parameter_identifiers, group.block)
 
-    async def handle_row_packet(self, packet: open_data_pb2.RowDataPacket):
-        ##  Get the parameter identifier
-        if packet.data_format.data_format_identifier != 0:
-            data_format_identifier = packet.data_format.data_format_identifier
-            parameter_identifiers = self.data_format_cache.get_cached_parameter_list(
-                data_format_identifier
-            )
-        else:
-            parameter_identifiers = (
-                packet.data_format.parameter_identifiers.parameter_identifiers
+    def write_periodic_block(
+        self, parameter_identifiers: List[str], block: SampleBlock
+    ):
+        """Add a block of periodic samples to the session."""
+        warn_on_failure(
+            self.writer.submit(
+                "add_columns",
+                parameter_identifiers,
+                block.values,
+                block.timestamps,
+            ),
+            "Failed to add data for parameters %s",
+            parameter_identifiers,
+        )
+
+    async def handle_buffered_row_packets(self, packets: List[BufferedPacket]):
+        """Decode buffered row data packets and queue them by data format.
+
+        The queued packets are counted against the budget of the row packet processor
+        with the memory they held while buffered.
+        """
+        groups = defaultdict(list)
+        for buffered_packet in packets:
+            packet = buffered_packet.decode()
+            groups[packet.data_format.data_format_identifier].append(
+                (packet, buffered_packet.nbytes)
             )
+        for group in groups.values():
+            with self.drop_on_failure(len(group), "RowDataPacket"):
+                await self.handle_row_packets(
+                    [packet for packet, _ in group], [nbytes for _, nbytes in group]
+                )
 
-        samples = getattr(packet.rows[0], packet.rows[0].WhichOneof("list")).samples
-        assert len(parameter_identifiers) == len(
-            samples
-        ), "The number of parameter identifiers should match the number of columns"
+    async def handle_row_packets(
+        self,
+        packets: List[open_data_pb2.RowDataPacket],
+        nbytes: Optional[List[int]] = None,
+    ):
+        """Queue row data packets of the same data format.
 
-        assert len(packet.timestamps) == len(packet.rows), (
-            "The number of timestamps" "should match the number of rows."
-        )
+        Args:
+            packets: Row data packets, all of the same data format.
+            nbytes: Memory each packet held while buffered, if known.
+        """
+        # Buffered size of each packet, by packet, as they are regrouped below.
+        packet_nbytes = None if nbytes is None else dict(zip(map(id, packets), nbytes))
 
-        # add config if there are no config for the parameters
-        if self.add_missing_config:
-            if await self.handle_packet_missing_config(packet, parameter_identifiers):
-                # If there are missing config then the packet is added to the queue and
-                # we return early
-                return
+        def column_count(packet):
+            return len(
+                getattr(packet.rows[0], packet.rows[0].WhichOneof("list")).samples
+            )
 
-        self.row_packet_processor.add_packet_to_queue(packet)
+        for parameter_identifiers, group in await self.group_by_parameters(
+            packets, column_count
+        ):
+            for packet in group:
+                assert len(parameter_identifiers) == column_count(packet), (
+                    "The number of parameter identifiers should match the number of "
+                    "columns"
+                )
+                assert len(packet.timestamps) == len(packet.rows), (
+                    "The number of timestamps" "should match the number of rows."
+                )
+
+            # add config if there are no config for the parameters
+            if self.add_missing_config:
+                if await self.handle_packet_missing_config(
+                    group, parameter_identifiers
+                ):
+                    # If there are missing config then the packets are added to the
+                    # queue and we move on
+                    continue
+
+            await self.row_packet_processor.add_packets_to_queue(
+                group,
+                parameter_identifiers,
+                (
+                    None
+                    if packet_nbytes is None
+                    else [packet_nbytes[id(packet)] for packet in group]
+                ),
+            )
 
     async def handle_marker_packet(self, packet: open_data_pb2.MarkerPacket):
         if packet.type == "Lap Trigger":
             timestamps_ns = packet.timestamp
             timestamps_sqlrace = np.mod(timestamps_ns, np.int64(1e9 * 3600 * 24))
-            self.session_writer.add_lap(timestamps_sqlrace, packet.value, packet.label)
+            self.writer.submit(
+                "add_lap", timestamps_sqlrace, packet.value, packet.label
+            )
         else:
             timestamps_ns = packet.timestamp
             timestamps_sqlrace = np.mod(timestamps_ns, np.int64(1e9 * 3600 * 24))
-            self.session_writer.add_marker(timestamps_sqlrace, packet.label)
+            self.writer.submit("add_marker", timestamps_sqlrace, packet.label)
 
     async def handle_metatdata_packet(self, packet: open_data_pb2.MetadataPacket):
         for key, any_value in packet.metadata.items():
@@ -461,42 +928,51 @@ class StreamReaderSql:
             if any_value.Is(wrappers_pb2.StringValue.DESCRIPTOR):
                 value = wrappers_pb2.StringValue()
                 any_value.Unpack(value)
-                self.session_writer.add_details(key, value.value)
+                self.writer.submit("add_details", key, value.value)
             elif any_value.Is(wrappers_pb2.DoubleValue.DESCRIPTOR):
                 value = wrappers_pb2.DoubleValue()
                 any_value.Unpack(value)
-                self.session_writer.add_details(key, value.value)
+                self.writer.submit("add_details", key, value.value)
             else:
                 print(f"Unsupported value type for metadata: {key}")
 
-    async def handle_event_packet(self, packet: open_data_pb2.EventPacket):
-        if packet.data_format.data_format_identifier != 0:
-            data_format_manager_stub = self.stream_api.data_format_manager_service_stub
-            event_identifier_response = data_format_manager_stub.GetEvent(
-                api_pb2.GetEventRequest(
-                    data_source=self.data_source,
-                    data_format_identifier=packet.data_format.data_format_identifier,
-                )
+    async def handle_event_packets(self, packets: List[open_data_pb2.EventPacket]):
+        data_format_identifier = packets[0].data_format.data_format_identifier
+        if data_format_identifier != 0:
+            event_identifier = await self.data_format_cache.get_cached_event_identifier(
+                data_format_identifier
             )
-            event_identifier = event_identifier_response.event
-        else:
-            event_identifier = packet.data_format.event_identifier
-
-        # add config if there are no config for the parameters
-        if self.add_missing_config:
-            if await self.handle_event_packet_missing_config(packet, event_identifier):
-                # If there are missing config then the packet is added to the queue and
-                # we return early
+            if event_identifier is None:
+                self.discarded_packets["unknown event data format"] += len(packets)
                 return
-        timestamps_ns = packet.timestamp
-        timestamps_sqlrace = np.mod(timestamps_ns, np.int64(1e9 * 3600 * 24))
-        if not await asyncio.to_thread(
-            self.session_writer.add_event_data,
-            event_identifier,
-            timestamps_sqlrace,
-            packet.raw_values,
-        ):
-            logger.warning("Failed to add event %s", event_identifier)
+            groups = {event_identifier: packets}
+        else:
+            groups = defaultdict(list)
+            for packet in packets:
+                groups[packet.data_format.event_identifier].append(packet)
+
+        for event_identifier, group in groups.items():
+            # add config if there are no config for the event
+            if self.add_missing_config:
+                if await self.handle_event_packet_missing_config(
+                    group, event_identifier
+                ):
+                    # If there are missing config then the packets are added to the
+                    # queue and we move on
+                    continue
+            for packet in group:
+                timestamps_ns = packet.timestamp
+                timestamps_sqlrace = np.mod(timestamps_ns, np.int64(1e9 * 3600 * 24))
+                warn_on_failure(
+                    self.writer.submit(
+                        "add_event_data",
+                        event_identifier,
+                        timestamps_sqlrace,
+                        packet.raw_values,
+                    ),
+                    "Failed to add event %s",
+                    event_identifier,
+                )
 
     async def main(self):
         # This stream reader will continuously wait for a live session until it is stopped.
@@ -507,12 +983,12 @@ class StreamReaderSql:
         # Set up a handler if we want to terminate early by ctrl+c
         signal.signal(signal.SIGINT, self.terminate_main_task)
         # Get the latest live session
-        current_session_response = session_management_stub.GetCurrentSessions(
+        current_session_response = await session_management_stub.GetCurrentSessions(
             api_pb2.GetCurrentSessionsRequest(data_source=self.data_source)
         )
 
         for test_key in current_session_response.session_keys[::-1]:
-            session_info_response = session_management_stub.GetSessionInfo(
+            session_info_response = await session_management_stub.GetSessionInfo(
                 api_pb2.GetSessionInfoRequest(session_key=test_key)
             )
             if not session_info_response.is_complete:
@@ -523,19 +999,21 @@ class StreamReaderSql:
         # if there is no live session wait for a new one to start
         if self.session_key is None:
             logger.info("No live session found, waiting for new session to start.")
-            for new_session in session_management_stub.GetSessionStartNotification(
+            async for (
+                new_session
+            ) in session_management_stub.GetSessionStartNotification(
                 api_pb2.GetSessionStartNotificationRequest(data_source=self.data_source)
             ):
                 self.session_key = new_session.session_key
                 logger.info("Identified live session %s", self.session_key)
                 break
 
-        session_info_response = session_management_stub.GetSessionInfo(
+        session_info_response = await session_management_stub.GetSessionInfo(
             api_pb2.GetSessionInfoRequest(session_key=self.session_key)
         )
         self.is_session_complete = session_info_response.is_complete
         while session_info_response.identifier == "":
-            session_info_response = session_management_stub.GetSessionInfo(
+            session_info_response = await session_management_stub.GetSessionInfo(
                 api_pb2.GetSessionInfoRequest(session_key=self.session_key)
             )
             self.is_session_complete = session_info_response.is_complete
@@ -543,7 +1021,11 @@ class StreamReaderSql:
         # Establish a new connection
         stream_offsets = []
         for stream in session_info_response.streams:
-            stream_offsets.append(session_info_response.topic_partition_offsets[f"{self.data_source}.{stream}:0"])
+            stream_offsets.append(
+                session_info_response.topic_partition_offsets[
+                    f"{self.data_source}.{stream}:0"
+                ]
+            )
         connection_details = api_pb2.ConnectionDetails(
             data_source=self.data_source,
             session_key=self.session_key,
@@ -553,21 +1035,57 @@ class StreamReaderSql:
             stream_offsets=stream_offsets,
         )
 
-        connection_response = connection_management_stub.NewConnection(
+        connection_response = await connection_management_stub.NewConnection(
             api_pb2.NewConnectionRequest(details=connection_details)
         )
 
         self.connection = connection_response.connection
 
-        # Create a corresponding ATLAS session
+        # Create a corresponding ATLAS session. The writer is imported here as it
+        # loads the SQLRace assemblies, which the decode pool workers must not do when
+        # they import this module.
+        # pylint: disable-next=import-outside-toplevel
+        from atlas_session_writer import AtlasSessionWriter
+
         self.session_writer = AtlasSessionWriter(
-            self.sqlrace_server, self.sqlrace_database, session_info_response.identifier
+            self.sqlrace_server,
+            self.sqlrace_database,
+            session_info_response.identifier,
+            self.config_cache_directory,
+        )
+        self.writer = SessionWriterActor(self.session_writer)
+        data_format_store = None
+        if self.data_format_store_directory is not None:
+            data_format_store = DataFormatStore(
+                self.data_format_store_directory, self.data_source
+            )
+        self.data_format_cache = DataFormatCache(
+            self.data_source, self.grpc_address, data_format_store
         )
-        self.data_format_cache = DataFormatCache(self.data_source, self.grpc_address)
+        self.data_format_cache.warm_up()
+        # Decoded row packets hold several times their buffered size, so the row
+        # queue gets a fraction of the backlog memory limit.
         self.row_packet_processor = RowPacketProcessor(
-            self.session_writer, self.data_format_cache
+            self.writer, self.data_format_cache, self.backlog_memory_limit // 8
         )
+        if self.decode_workers > 0:
+            self.decode_pool = DecodePool(
+                self.decode_workers, block_size=self.periodic_batch_size
+            )
 
+        self.stream_discovery_requested = asyncio.Event()
+        self.packets_to_add = PacketBacklog(
+            self.backlog_spill_directory, self.backlog_memory_limit
+        )
+        self.credit_gate = CreditGate(
+            lambda: self.packets_to_add.nbytes,
+            min_credits=self.backlog_memory_limit // 64,
+            max_credits=self.backlog_memory_limit,
+        )
+        if self.backlog_spill_directory is not None:
+            # The backlog spills to disk rather than holding back the packet reader,
+            # so the reader keeps up with the live session.
+            self.credit_gate.disable()
         # Read essential stream which contains essential information such as configs
         self.read_essentials_task = asyncio.create_task(self.read_essentials())
 
@@ -579,6 +1097,7 @@ class StreamReaderSql:
         self.schedule_process_queue_task = asyncio.create_task(
             self.schedule_process_queue()
         )
+        self.discover_streams_task = asyncio.create_task(self.discover_streams())
         logger.debug("Starting main task.")
         await self.main_task
 
@@ -595,8 +1114,23 @@ if __name__ == "__main__":
 
     sqlrace_server = config["sqlRaceServer"]
     sqlrace_database = config["sqlRaceDatabase"]
+    configure_channel_pool(ChannelSettings.from_config(config.get("grpcChannel", {})))
     with StreamReaderSql(sqlrace_server, sqlrace_database) as stream_recorder:
         stream_recorder.data_source = config["dataSource"]
+        stream_recorder.data_format_store_directory = config.get(
+            "dataFormatStoreDirectory"
+        )
+        stream_recorder.config_cache_directory = config.get("configCacheDirectory")
+        if config.get("backlogMemoryLimitMB") is not None:
+            stream_recorder.backlog_memory_limit = int(
+                config["backlogMemoryLimitMB"] * 2**20
+            )
+        stream_recorder.backlog_spill_directory = config.get("backlogSpillDirectory")
+        stream_recorder.decode_workers = config.get("decodeWorkers", 0)
+        if config.get("packetTypes") is not None:
+            stream_recorder.packet_types = set(config["packetTypes"])
+        if config.get("streams") is not None:
+            stream_recorder.streams = set(config["streams"])
         # Specify a session key to process sessions historically.
         # stream_recorder.session_key = "b0d7b0f9-46cf-48ca-a59a-766c2c0f1815"
-        asyncio.run(stream_recorder.main())
+        asyncio.run(stream_recorder.run())
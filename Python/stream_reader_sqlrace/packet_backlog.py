@@ -0,0 +1,212 @@
+"""Backlog of the packets waiting to be routed to their handlers."""
+
+import itertools
+import logging
+import mmap
+import os
+import struct
+import sys
+from collections import deque
+from typing import Deque, Dict, List, NamedTuple, Optional, Tuple, Type
+
+from google.protobuf.message import Message
+
+logger = logging.getLogger(__name__)
+
+# Header of a spilled packet: its message class code and the length of its content.
+_RECORD_HEADER = struct.Struct("<HI")
+_segment_numbers = itertools.count()
+
+
+class BufferedPacket(NamedTuple):
+    """Content of a packet, kept encoded until it is routed, and its message class.
+
+    A decoded packet holds a message object for every sample, which takes several
+    times the memory of its encoded content.
+    """
+
+    message_class: Type[Message]
+    content: bytes
+
+    @classmethod
+    def encode(cls, packet: Message) -> "BufferedPacket":
+        return cls(type(packet), packet.SerializeToString())
+
+    def decode(self) -> Message:
+        return self.message_class.FromString(self.content)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the buffered packet, in bytes."""
+        return len(self.content) + _ENTRY_SIZE
+
+
+# Memory held by a buffered packet besides its content: the tuple, the bytes object
+# header and the slot of the backlog referencing it.
+_ENTRY_SIZE = sys.getsizeof(BufferedPacket(Message, b"")) + sys.getsizeof(b"") + 8
+
+
+class _Segment:
+    """Append-only file of spilled packets, read back through a memory map.
+
+    The file is sealed the first time it is read from, so packets spilled after that
+    go to a new segment.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.size = 0
+        # Number of packets written and not read yet.
+        self.count = 0
+        self._file = open(path, "wb")  # pylint: disable=consider-using-with
+        self._mmap: Optional[mmap.mmap] = None
+        self._offset = 0
+
+    @property
+    def writable(self) -> bool:
+        return self._file is not None
+
+    def write(self, code: int, content: bytes) -> int:
+        """Append a packet, returning the number of bytes written."""
+        self._file.write(_RECORD_HEADER.pack(code, len(content)))
+        self._file.write(content)
+        self.count += 1
+        written = _RECORD_HEADER.size + len(content)
+        self.size += written
+        return written
+
+    def read(self, max_items: int) -> List[Tuple[int, bytes]]:
+        """Read up to `max_items` packets, as their class code and content."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._mmap is None:
+            with open(self.path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        records = []
+        while len(records) < max_items and self._offset < self.size:
+            code, length = _RECORD_HEADER.unpack_from(self._mmap, self._offset)
+            start = self._offset + _RECORD_HEADER.size
+            records.append((code, self._mmap[start : start + length]))
+            self._offset = start + length
+        self.count -= len(records)
+        return records
+
+    def close(self):
+        """Close and delete the segment."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        os.remove(self.path)
+
+
+class PacketBacklog:
+    """FIFO of buffered packets, drained from the head in chunks.
+
+    Taking a chunk of k packets from the head is O(k), and packets to retry later are
+    pushed back to the head in their original order, so the rest of the backlog is
+    never copied. The memory held by the buffered packets is kept in `nbytes`.
+
+    If a spill directory is given, the packets that would take the backlog over its
+    memory budget are appended to segment files in that directory instead, as are
+    all the packets after them until they are drained. Spilled packets are read back
+    in order once the packets ahead of them are drained, and each segment is deleted
+    once it has been read.
+
+    Attributes:
+        spill_directory: Directory to spill packets to, or None to keep them all in
+            memory.
+        memory_budget: Most memory the packets kept in memory may hold, in bytes.
+            It only applies if packets can be spilled.
+        segment_size: Size of the segment files, in bytes.
+        spilled_nbytes: Bytes of the spilled packets not read back yet.
+    """
+
+    def __init__(
+        self,
+        spill_directory: Optional[str] = None,
+        memory_budget: int = 512 * 2**20,
+        segment_size: int = 64 * 2**20,
+    ):
+        self._packets: Deque[BufferedPacket] = deque()
+        self.nbytes = 0
+        self.spill_directory = spill_directory
+        self.memory_budget = memory_budget
+        self.segment_size = segment_size
+        self.spilled_nbytes = 0
+        self._spilled_count = 0
+        self._segments: Deque[_Segment] = deque()
+        # Message classes of the spilled packets, by the code they are spilled with.
+        self._message_classes: List[Type[Message]] = []
+        self._class_codes: Dict[Type[Message], int] = {}
+        if spill_directory is not None:
+            os.makedirs(spill_directory, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._packets) + self._spilled_count
+
+    def append(self, packet: BufferedPacket) -> None:
+        if self._segments or (
+            self.spill_directory is not None
+            and self.nbytes + packet.nbytes > self.memory_budget
+        ):
+            self._spill(packet)
+        else:
+            self._packets.append(packet)
+            self.nbytes += packet.nbytes
+
+    def _spill(self, packet: BufferedPacket):
+        code = self._class_codes.get(packet.message_class)
+        if code is None:
+            code = self._class_codes[packet.message_class] = len(self._message_classes)
+            self._message_classes.append(packet.message_class)
+        if not self._segments:
+            logger.info(
+                "Backlog over its memory budget of %.1f MB, spilling packets to %s",
+                self.memory_budget / 2**20,
+                self.spill_directory,
+            )
+        segment = self._segments[-1] if self._segments else None
+        if segment is None or not segment.writable or segment.size > self.segment_size:
+            segment = _Segment(
+                os.path.join(
+                    self.spill_directory,
+                    f"backlog-{os.getpid()}-{next(_segment_numbers)}.segment",
+                )
+            )
+            self._segments.append(segment)
+        self.spilled_nbytes += segment.write(code, packet.content)
+        self._spilled_count += 1
+
+    def pop_chunk(self, max_items: int) -> List[BufferedPacket]:
+        """Remove and return up to `max_items` packets from the head."""
+        popleft = self._packets.popleft
+        packets = [popleft() for _ in range(min(max_items, len(self._packets)))]
+        self.nbytes -= sum(packet.nbytes for packet in packets)
+        while len(packets) < max_items and self._segments:
+            segment = self._segments[0]
+            for code, content in segment.read(max_items - len(packets)):
+                packets.append(BufferedPacket(self._message_classes[code], content))
+                self.spilled_nbytes -= _RECORD_HEADER.size + len(content)
+                self._spilled_count -= 1
+            if segment.count == 0:
+                segment.close()
+                self._segments.popleft()
+                if not self._segments:
+                    logger.info("Spilled packets all read back from disk")
+        return packets
+
+    def push_front(self, packets: List[BufferedPacket]) -> None:
+        """Put packets back at the head, ahead of the rest of the backlog."""
+        self._packets.extendleft(reversed(packets))
+        self.nbytes += sum(packet.nbytes for packet in packets)
+
+    def close(self) -> None:
+        """Delete the segment files, discarding the packets still spilled in them."""
+        while self._segments:
+            self._segments.popleft().close()
+        self._spilled_count = 0
+        self.spilled_nbytes = 0
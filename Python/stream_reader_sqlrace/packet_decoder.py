@@ -0,0 +1,123 @@
+"""Columnar decoding of Open Data sample packets into NumPy arrays."""
+
+from itertools import chain
+from operator import attrgetter
+from typing import List, NamedTuple
+
+import numpy as np
+
+from ma.streaming.open_data.v1 import open_data_pb2
+
+# SQLRace timestamps are in nanoseconds since midnight.
+NS_PER_DAY = np.int64(1e9 * 3600 * 24)
+DATA_STATUS_VALID = open_data_pb2.DataStatus.DATA_STATUS_VALID
+
+_get_value = attrgetter("value")
+_get_status = attrgetter("status")
+
+
+class SampleBlock(NamedTuple):
+    """Decoded samples of a single packet.
+
+    Attributes:
+        timestamps: Timestamps of each sample, in SQLRace format.
+        values: Samples x parameters matrix of float64 values. The matrix is stored in
+            column major order, so the samples of each parameter are contiguous.
+            Samples which are not valid are set to NaN.
+        valid: Samples x parameters mask, True where the sample status is valid.
+    """
+
+    timestamps: np.ndarray
+    values: np.ndarray
+    valid: np.ndarray
+
+
+def to_sqlrace_timestamps(timestamps_ns) -> np.ndarray:
+    """Convert timestamps in ns since UNIX epoch to SQLRace format."""
+    return np.mod(np.asarray(timestamps_ns, dtype=np.int64), NS_PER_DAY)
+
+
+def _read_samples(sample_list, values: np.ndarray, status: np.ndarray) -> None:
+    """Read the value and status of every sample into `values` and `status`."""
+    # Indexing a protobuf repeated field is costly, so materialise it once and let
+    # the attribute getters run in C.
+    samples = list(getattr(sample_list, sample_list.WhichOneof("list")).samples)
+    values[:] = list(map(_get_value, samples))
+    status[:] = list(map(_get_status, samples))
+
+
+def _to_block(timestamps_ns, values: np.ndarray, status: np.ndarray) -> SampleBlock:
+    valid = status == DATA_STATUS_VALID
+    values[~valid] = np.nan
+    return SampleBlock(to_sqlrace_timestamps(timestamps_ns), values, valid)
+
+
+def _empty_columns(sample_count: int, parameter_count: int):
+    shape = (sample_count, parameter_count)
+    return (
+        np.empty(shape, dtype=np.float64, order="F"),
+        np.empty(shape, dtype=np.int32, order="F"),
+    )
+
+
+def decode_periodic_packet(packet: open_data_pb2.PeriodicDataPacket) -> SampleBlock:
+    """Decode a PeriodicDataPacket into a SampleBlock.
+
+    Args:
+        packet: Periodic data packet, every column must have the same number of samples.
+
+    Returns:
+        SampleBlock with one column per parameter of the packet.
+    """
+    columns = packet.columns
+    if len(columns) == 0:
+        return _to_block([], *_empty_columns(0, 0))
+    first = columns[0]
+    sample_count = len(getattr(first, first.WhichOneof("list")).samples)
+    values, status = _empty_columns(sample_count, len(columns))
+    for i, column in enumerate(columns):
+        _read_samples(column, values[:, i], status[:, i])
+
+    timestamps_ns = packet.start_time + packet.interval * np.arange(
+        sample_count, dtype=np.int64
+    )
+    return _to_block(timestamps_ns, values, status)
+
+
+def decode_row_packet(packet: open_data_pb2.RowDataPacket) -> SampleBlock:
+    """Decode a RowDataPacket into a SampleBlock.
+
+    All the rows are read in one pass and transposed into a samples x parameters
+    matrix. The timestamps of the rows are converted to SQLRace format like those of
+    the other packets, rather than being passed on in ns since UNIX epoch.
+
+    Args:
+        packet: Row data packet, every row must have the same number of samples.
+
+    Returns:
+        SampleBlock with one sample per row of the packet.
+    """
+    samples = list(
+        chain.from_iterable(
+            getattr(row, row.WhichOneof("list")).samples for row in packet.rows
+        )
+    )
+    shape = (len(packet.rows), len(samples) // max(len(packet.rows), 1))
+    values = np.array(list(map(_get_value, samples)), dtype=np.float64)
+    status = np.array(list(map(_get_status, samples)), dtype=np.int32)
+    return _to_block(
+        packet.timestamps,
+        np.asfortranarray(values.reshape(shape)),
+        np.asfortranarray(status.reshape(shape)),
+    )
+
+
+def concatenate_blocks(blocks: List[SampleBlock]) -> SampleBlock:
+    """Stack the samples of blocks sharing the same parameters into one block."""
+    if len(blocks) == 1:
+        return blocks[0]
+    return SampleBlock(
+        np.concatenate([block.timestamps for block in blocks]),
+        np.asfortranarray(np.concatenate([block.values for block in blocks])),
+        np.asfortranarray(np.concatenate([block.valid for block in blocks])),
+    )
@@ -0,0 +1,86 @@
+"""Registry resolving the packets received from the Stream API to their handlers."""
+
+import logging
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Type
+
+from google.protobuf.message import Message
+
+logger = logging.getLogger(__name__)
+
+PacketHandler = Callable[[Any], Awaitable[None]]
+BulkPacketHandler = Callable[[List[Any]], Awaitable[None]]
+
+
+class PacketRegistry:
+    """Packet types the reader handles, resolved once rather than for every packet.
+
+    The `type` of a packet envelope maps to the message class its content is decoded
+    with, and the message class to the coroutine handling the decoded packets.
+    Handlers are bulk handlers: they are called with lists of packets of the same
+    class and data format. Packets of an unregistered type are counted by type,
+    rather than logged one by one.
+    """
+
+    def __init__(self):
+        self._by_type: Dict[str, Type[Message]] = {}
+        self._by_class: Dict[Type[Message], BulkPacketHandler] = {}
+        self.unknown_types = Counter()
+
+    def register(
+        self, packet_type: str, message_class: Type[Message], handler: PacketHandler
+    ) -> None:
+        """Register a handler called with each packet of a type, one at a time.
+
+        Args:
+            packet_type: `type` of the packet envelope, e.g. "PeriodicData".
+            message_class: Protobuf message class of the packet content.
+            handler: Coroutine function called with each decoded packet.
+        """
+
+        async def handle_each(packets: List[Any]):
+            for packet in packets:
+                await handler(packet)
+
+        self.register_bulk(packet_type, message_class, handle_each)
+
+    def register_bulk(
+        self,
+        packet_type: str,
+        message_class: Type[Message],
+        handler: BulkPacketHandler,
+    ) -> None:
+        """Register a handler called with lists of packets of a type.
+
+        Any previous handler of the packet type is replaced.
+
+        Args:
+            packet_type: `type` of the packet envelope, e.g. "PeriodicData".
+            message_class: Protobuf message class of the packet content.
+            handler: Coroutine function called with lists of decoded packets, all of
+                the same data format.
+        """
+        self._by_type[packet_type] = message_class
+        self._by_class[message_class] = handler
+
+    def message_class(self, packet_type: str) -> Optional[Type[Message]]:
+        """Message class of a packet type, or None if the type is unknown."""
+        message_class = self._by_type.get(packet_type)
+        if message_class is None:
+            self._count_unknown(packet_type)
+        return message_class
+
+    def handler(self, message_class: Type[Message]) -> BulkPacketHandler:
+        """Bulk handler of the packets decoded as `message_class`."""
+        return self._by_class[message_class]
+
+    def _count_unknown(self, packet_type: str):
+        if packet_type not in self.unknown_types:
+            logger.info(
+                "Unknown packet type %s, its packets are discarded.", packet_type
+            )
+        self.unknown_types[packet_type] += 1
+
+    def log_unknown_types(self) -> None:
+        for packet_type, count in self.unknown_types.most_common():
+            logger.info("Discarded %i packets of unknown type %s", count, packet_type)
@@ -0,0 +1,49 @@
+"""Packets waiting for the configuration of the parameters or events they contain."""
+
+import itertools
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+
+class ParkedPackets:
+    """Packets parked until all their missing identifiers are configured.
+
+    Each group of packets is indexed by the identifiers it is missing, so configuring
+    an identifier only looks at the groups waiting for it, and the packets are not
+    re-examined in the meantime. Released packets are returned in the order they were
+    parked.
+    """
+
+    def __init__(self):
+        self._order = itertools.count()
+        # Parked groups, by order of parking, with the identifiers they still miss.
+        self._groups: Dict[int, Tuple[List[Any], Set[str]]] = {}
+        # Order of the groups waiting for each identifier.
+        self._waiting: Dict[str, Set[int]] = {}
+        self._packet_count = 0
+
+    def __len__(self) -> int:
+        return self._packet_count
+
+    def park(self, packets: List[Any], missing_identifiers: Iterable[str]) -> None:
+        """Park packets until all of `missing_identifiers` are configured."""
+        order = next(self._order)
+        missing_identifiers = set(missing_identifiers)
+        self._groups[order] = (packets, missing_identifiers)
+        for identifier in missing_identifiers:
+            self._waiting.setdefault(identifier, set()).add(order)
+        self._packet_count += len(packets)
+
+    def release(self, configured_identifiers: Iterable[str]) -> List[Any]:
+        """Remove and return the packets no longer missing any configuration."""
+        released = []
+        for identifier in configured_identifiers:
+            for order in self._waiting.pop(identifier, ()):
+                missing_identifiers = self._groups[order][1]
+                missing_identifiers.discard(identifier)
+                if not missing_identifiers:
+                    released.append(order)
+        packets = []
+        for order in sorted(released):
+            packets.extend(self._groups.pop(order)[0])
+        self._packet_count -= len(packets)
+        return packets
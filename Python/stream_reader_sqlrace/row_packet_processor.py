@@ -1,24 +1,44 @@
+import asyncio
 import logging
-from multiprocessing import Queue, Manager
-from typing import List, Dict
 import threading
 import time
-import numpy as np
+from typing import List, Optional
 
 from ma.streaming.open_data.v1 import open_data_pb2
+from stream_reader_sqlrace.batching_queue import KeyedBatchQueue
+from stream_reader_sqlrace.packet_decoder import concatenate_blocks, decode_row_packet
+from stream_reader_sqlrace.session_writer_actor import (
+    SessionWriterActor,
+    warn_on_failure,
+)
 
 logger = logging.getLogger(__name__)
 
 
 class RowPacketProcessor:
 
-    def __init__(self, session_writer, data_format_cache):
-        self.packet_queues: Dict[int, Queue] = {}
-        self.session_writer = session_writer
+    def __init__(
+        self,
+        writer: SessionWriterActor,
+        data_format_cache,
+        memory_budget: int = 64 * 2**20,
+    ):
+        # Queued packets are kept with the memory they held while buffered.
+        self.packet_queues = KeyedBatchQueue(sizeof=lambda item: item[1])
+        self.writer = writer
         self.data_format_cache = data_format_cache
-        self.queue_threshold = 50
+        # Parameter identifiers of each queued data format.
+        self.parameter_identifiers = {}
+        # Buffered size of the queued packets over which they are written straight
+        # away, in bytes.
+        self.memory_budget = memory_budget
         self.process_interval = 30
-        self.processing_queues = False
+        self.batch_size = 1000
+        self.processing_lock = threading.Lock()
+        # Set to have the background thread drain the queues before the next interval.
+        self.drain_requested = threading.Event()
+        # Notified whenever a drain of the queues finishes.
+        self.drain_finished = threading.Condition()
 
         # Start the background thread
         self.stop_event = threading.Event()
@@ -29,91 +49,137 @@ class RowPacketProcessor:
 
     @property
     def max_queue_length(self):
-        if len(self.packet_queues) > 0:
-            return max(queue.qsize() for (key, queue) in self.packet_queues.items())
-        return 0
-
-    def add_packet_to_queue(self, packet: open_data_pb2.RowDataPacket):
-        if packet.data_format.data_format_identifier == 0:
+        return self.packet_queues.max_depth
+
+    async def add_packets_to_queue(
+        self,
+        packets: List[open_data_pb2.RowDataPacket],
+        parameter_identifiers: List[str],
+        nbytes: Optional[List[int]] = None,
+    ):
+        """Queue row packets to be written with the other packets of their data format.
+
+        Args:
+            packets: Row data packets, all with the same columns.
+            parameter_identifiers: Parameter identifiers of the columns of the packets.
+            nbytes: Memory each packet held while buffered, counted against
+                `memory_budget`. Defaults to the encoded size of the packets.
+        """
+        if packets[0].data_format.data_format_identifier == 0:
             data_format_identifier = (
-                self.data_format_cache.get_cached_data_format_identifier(
-                    packet.data_format.parameter_identifiers.parameter_identifiers
+                await self.data_format_cache.get_cached_data_format_identifier(
+                    parameter_identifiers
                 )
             )
         else:
-            data_format_identifier = packet.data_format.data_format_identifier
+            data_format_identifier = packets[0].data_format.data_format_identifier
 
-        if data_format_identifier not in self.packet_queues:
-            q = Queue()
-            self.packet_queues[data_format_identifier] = q
+        if data_format_identifier not in self.parameter_identifiers:
+            self.parameter_identifiers[data_format_identifier] = list(
+                parameter_identifiers
+            )
+        if nbytes is None:
+            nbytes = [packet.ByteSize() for packet in packets]
+        self.packet_queues.put_many(data_format_identifier, list(zip(packets, nbytes)))
+        if self.packet_queues.nbytes > self.memory_budget:
+            # The background thread drains the queues, so the rows are not decoded on
+            # the event loop, which waits for the queues to be back within budget.
+            self.drain_requested.set()
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.wait_within_budget, self.process_interval
+            )
 
-        self.packet_queues[data_format_identifier].put(packet)
-        if self.packet_queues[data_format_identifier].qsize() > self.queue_threshold:
-            self.process_queues()
+    def wait_within_budget(self, timeout: float) -> bool:
+        """Wait for the queues to be drained within `memory_budget`.
+
+        Returns:
+            True if the queues are within budget, False if `timeout` seconds passed.
+        """
+        with self.drain_finished:
+            return self.drain_finished.wait_for(
+                lambda: self.packet_queues.nbytes <= self.memory_budget
+                or self.stop_event.is_set(),
+                timeout,
+            )
 
     def schedule_process_queue(self):
         while not self.stop_event.is_set():
-            time.sleep(self.process_interval)
+            self.drain_requested.wait(self.process_interval)
+            self.drain_requested.clear()
             self.process_queues()
-            if len(self.packet_queues) != 0:
-                while self.max_queue_length > self.queue_threshold:
-                    self.process_queues()
-
-    def process_queues(self, process_all_packets=False):
-        if self.processing_queues:
-            return
-        self.processing_queues = True
-        manager = Manager()
-        shared_data = manager.dict()
-
-        sorted_queues = sorted(
-            self.packet_queues.items(), key=lambda item: item[1].qsize(), reverse=True
-        )
+            while (
+                self.packet_queues.nbytes > self.memory_budget
+                and not self.stop_event.is_set()
+            ):
+                if not self.process_queues():
+                    # Another drain is running, wait for it rather than spinning.
+                    with self.drain_finished:
+                        self.drain_finished.wait_for(
+                            lambda: not self.processing_lock.locked()
+                            or self.stop_event.is_set(),
+                            self.process_interval,
+                        )
+
+    def process_queues(self, process_all_packets=False) -> bool:
+        """Drain the queues, unless they are already being drained.
+
+        Returns:
+            True if the queues were drained, False if another thread is draining them.
+        """
+        if not self.processing_lock.acquire(blocking=False):
+            return False
+        try:
+            self._process_queues(process_all_packets)
+        finally:
+            self.processing_lock.release()
+            with self.drain_finished:
+                self.drain_finished.notify_all()
+        return True
+
+    def _process_queues(self, process_all_packets):
+        sorted_queues = self.packet_queues.keys_by_depth()
 
         in_process_count = 0
         start_time = time.time()
-        for data_format_identifier, queue in sorted_queues:
+        for data_format_identifier in sorted_queues:
             if (
                 not process_all_packets
                 and time.time() - start_time > self.process_interval
             ):
                 logger.debug("Terminating early due to timeout.")
                 break
-            parameter_identifiers = self.data_format_cache.get_cached_parameter_list(
-                data_format_identifier
-            )
-            packets = []
-            while not (queue.empty() and len(packets) < 1000):
-                packets.append(queue.get())
+            parameter_identifiers = self.parameter_identifiers[data_format_identifier]
+            packets = [
+                packet
+                for packet, _ in self.packet_queues.drain(
+                    data_format_identifier, self.batch_size
+                )
+            ]
+            if len(packets) == 0:
+                continue
 
+            # Transpose all the rows of the queued packets into a single block, so
+            # each channel is written once.
+            blocks = []
             for packet in packets:
-                samples = getattr(
-                    packet.rows[0], packet.rows[0].WhichOneof("list")
-                ).samples
-                assert len(parameter_identifiers) == len(
-                    samples
-                ), "The number of parameter identifiers should match the number of columns"
                 assert len(packet.timestamps) == len(
                     packet.rows
                 ), "The number of timestamps should match the number of rows."
-
-                for timestamps_ns, row in zip(packet.timestamps, packet.rows):
-                    samples = getattr(row, row.WhichOneof("list")).samples
-                    data = [
-                        (
-                            s.value
-                            if s.status == open_data_pb2.DataStatus.DATA_STATUS_VALID
-                            else np.nan
-                        )
-                        for s in samples
-                    ]
-                    if not self.session_writer.add_row(
-                        parameter_identifiers, data, timestamps_ns
-                    ):
-                        logger.warning(
-                            "Failed to add data for parameters %s",
-                            parameter_identifiers,
-                        )
+                block = decode_row_packet(packet)
+                assert len(parameter_identifiers) == block.values.shape[1], (
+                    "The number of parameter identifiers should match the number of "
+                    "columns"
+                )
+                blocks.append(block)
+            block = concatenate_blocks(blocks)
+
+            warn_on_failure(
+                self.writer.submit(
+                    "add_columns", parameter_identifiers, block.values, block.timestamps
+                ),
+                "Failed to add data for parameters %s",
+                parameter_identifiers,
+            )
             in_process_count += 1
 
         logger.info(
@@ -123,10 +189,11 @@ class RowPacketProcessor:
             self.max_queue_length,
         )
 
-        self.processing_queues = False
-
     def stop(self):
         self.stop_event.set()
+        self.drain_requested.set()
+        with self.drain_finished:
+            self.drain_finished.notify_all()
         self.background_thread.join()
         while self.max_queue_length > 0:
             self.process_queues(True)
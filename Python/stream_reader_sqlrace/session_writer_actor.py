@@ -0,0 +1,101 @@
+"""Run all the writes to an ATLAS session on a single dedicated thread."""
+
+import asyncio
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class SessionWriterActor:
+    """Single threaded executor for the AtlasSessionWriter.
+
+    Callers enqueue commands, by method name, and carry on without waiting for the
+    session. The writer thread executes the commands strictly in the order they were
+    submitted, so a configuration submitted before data is always committed before
+    the data is written. Commands are drained in batches, and aged write buffers are
+    flushed between batches or when the thread is idle.
+    """
+
+    def __init__(self, session_writer):
+        self.session_writer = session_writer
+        self.batch_size = 1000
+        self.idle_interval = 1.0  # seconds
+        self.commands = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name="session_writer_thread")
+        self.thread.start()
+
+    @property
+    def pending(self) -> int:
+        """Number of commands waiting to be executed."""
+        return self.commands.qsize()
+
+    def submit(self, method_name: str, *args) -> Future:
+        """Enqueue a call to an AtlasSessionWriter method.
+
+        Args:
+            method_name: Name of the AtlasSessionWriter method to call.
+            *args: Arguments of the call.
+
+        Returns:
+            Future that resolves to the return value of the call.
+        """
+        future = Future()
+        method = getattr(self.session_writer, method_name)
+        self.commands.put((method, args, future))
+        return future
+
+    async def call(self, method_name: str, *args):
+        """Enqueue a call to an AtlasSessionWriter method and await its result."""
+        return await asyncio.wrap_future(self.submit(method_name, *args))
+
+    async def drained(self):
+        """Wait until all the commands submitted so far are executed."""
+        future = Future()
+        self.commands.put((lambda: None, (), future))
+        await asyncio.wrap_future(future)
+
+    def run(self):
+        while True:
+            try:
+                batch = [self.commands.get(timeout=self.idle_interval)]
+            except queue.Empty:
+                self.session_writer.flush_expired()
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.commands.get_nowait())
+                except queue.Empty:
+                    break
+
+            for command in batch:
+                if command is _STOP:
+                    return
+                method, args, future = command
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(method(*args))
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    logger.exception("Session writer command %s failed.", method)
+                    future.set_exception(e)
+            self.session_writer.flush_expired()
+
+    def stop(self):
+        """Execute all the enqueued commands and stop the writer thread."""
+        self.commands.put(_STOP)
+        self.thread.join()
+
+
+def warn_on_failure(future: Future, message: str, *args) -> None:
+    """Log a warning once `future` resolves to False."""
+
+    def callback(done: Future):
+        if done.exception() is None and not done.result():
+            logger.warning(message, *args)
+
+    future.add_done_callback(callback)
@@ -13,7 +13,6 @@ import datetime
 import time
 import logging
 
-import grpc
 from google.protobuf import wrappers_pb2, any_pb2
 
 from ma.streaming.api.v1 import api_pb2
@@ -21,7 +20,7 @@ from ma.streaming.api.v1.api_pb2_grpc import PacketWriterServiceStub
 from ma.streaming.open_data.v1 import open_data_pb2
 from ma.streaming.key_generator.v1 import key_generator_pb2_grpc, key_generator_pb2
 from packet_builder import SinWaveGenerator
-from stream_api import StreamApi
+from stream_api import StreamApi, channel_pool
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -47,7 +46,7 @@ def get_packet_type(packet_content) -> str:
 def get_new_key_string():
     """Get a new string key from the key generator service."""
 
-    channel = grpc.insecure_channel(KEY_GENERATOR_SERVER_ADDRESS)
+    channel = channel_pool.channel(KEY_GENERATOR_SERVER_ADDRESS)
     key_gen_stub = key_generator_pb2_grpc.UniqueKeyGeneratorServiceStub(channel)
     key_gen_response = key_gen_stub.GenerateUniqueKey(
         key_generator_pb2.GenerateUniqueKeyRequest(